@@ -1,7 +1,12 @@
 import os
+import hashlib
+import hmac
 import json
 import logging
-import time, random
+import mimetypes
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from uuid import uuid4
 from datetime import datetime, timedelta
 from pathlib import Path
@@ -14,11 +19,12 @@ logging.basicConfig(
 log = logging.getLogger("appsolicitud")
 
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 from google.cloud import storage  # GCS
-from google.oauth2.service_account import Credentials
+from google.api_core.exceptions import PreconditionFailed
+from google.auth.transport.requests import AuthorizedSession
 from gspread.utils import rowcol_to_a1
-import yagmail
 from zoneinfo import ZoneInfo
 
 # --- LIBRERÍAS IA ---
@@ -39,30 +45,31 @@ MAX_VIDEO_BYTES = MAX_VIDEO_MB * _MB
 
 IMAGE_EXTS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
 VIDEO_EXTS = {'.mp4', '.mov', '.avi', '.wmv', '.mkv', '.webm', '.ogg'}
+# Extensiones para st.file_uploader: el navegador filtra antes de subir
+UPLOAD_TYPES = sorted(e.lstrip('.') for e in IMAGE_EXTS | VIDEO_EXTS)
+
+# Tipo de archivo por extensión y límite por tipo: una búsqueda en dict cada uno
+_EXT_KIND = {**{e: "image" for e in IMAGE_EXTS}, **{e: "video" for e in VIDEO_EXTS}}
+_LIMITES = {
+    "image": (MAX_IMAGE_BYTES, "La imagen", MAX_IMAGE_MB),
+    "video": (MAX_VIDEO_BYTES, "El video", MAX_VIDEO_MB),
+}
 
 def _guess_is_image_or_video(file_name: str, mime: Optional[str]):
-    ext = Path(file_name).suffix.lower()
-    if mime:
-        if mime.startswith("image/"): return "image", ext
-        if mime.startswith("video/"): return "video", ext
-    if ext in IMAGE_EXTS: return "image", ext
-    if ext in VIDEO_EXTS: return "video", ext
-    return None, ext
+    ext = os.path.splitext(file_name)[1].lower()
+    top = mime.split("/", 1)[0] if mime else ""
+    if top in _LIMITES: return top, ext
+    return _EXT_KIND.get(ext), ext
 
 def validate_upload_limits(uploaded_file) -> tuple[bool, str]:
     if uploaded_file is None: return True, ""
-    kind, _ext = _guess_is_image_or_video(uploaded_file.name, getattr(uploaded_file, "type", None))
-    size = getattr(uploaded_file, "size", 0)
-    size_mb = size / _MB
-
-    if kind == "image":
-        if size > MAX_IMAGE_BYTES:
-            return False, f"❌ La imagen pesa {size_mb:.2f} MB y el límite es {MAX_IMAGE_MB} MB."
-    elif kind == "video":
-        if size > MAX_VIDEO_BYTES:
-            return False, f"❌ El video pesa {size_mb:.2f} MB y el límite es {MAX_VIDEO_MB} MB."
-    else:
+    kind, _ext = _guess_is_image_or_video(uploaded_file.name, uploaded_file.type)
+    if kind is None:
         return False, "❌ Solo se permiten imágenes o videos."
+    max_bytes, etiqueta, max_mb = _LIMITES[kind]
+    # El tipo se rechaza antes de mirar el tamaño
+    if uploaded_file.size > max_bytes:
+        return False, f"❌ {etiqueta} pesa {uploaded_file.size / _MB:.2f} MB y el límite es {max_mb} MB."
     return True, ""
 
 # =========================
@@ -83,48 +90,114 @@ st.set_page_config(page_title="Gestor Zoho CRM", layout="wide")
 
 # --- Módulos internos (importados después de set_page_config) ---
 from modules.sheets import (
-    with_backoff, get_records_simple,
+    with_backoff, get_records_simple, clear_records_cache, append_row_coalesced, delete_rows_batch, ids_en_filas, clear_headers_cache,
+    mount_http_pool, get_sa_credentials, get_headers, get_col_idx, _values_to_df,
     sheet_solicitudes, sheet_incidencias, sheet_quejas, sheet_usuarios,
 )
-from modules.email_utils import enviar_correo, SEND_EMAILS
-from modules.auth import _email_norm, do_login, do_logout, get_usuarios_dict
+from modules.email_utils import (
+    enviar_correo, send_mail_async, remitente, render, SEND_EMAILS,
+    TPL_SOLICITUD_ATENDIDA, TPL_INCIDENCIA_RESUELTA, TPL_ACTUALIZACION,
+)
+from modules.auth import _email_norm, email_norm_series, do_login, do_logout, buscar_usuario
+
+# --- Pool de I/O en segundo plano (subidas, llamadas de red independientes) ---
+@st.cache_resource
+def get_io_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="io")
+
+def submit_with_ctx(fn, *args, **kwargs):
+    """Ejecuta fn en el pool de I/O conservando el contexto de Streamlit
+    del rerun actual (lo usan st.cache_*). fn no debe pintar elementos
+    (st.toast / st.error): devuelve un estado y el hilo principal los muestra.
+    """
+    ctx = get_script_run_ctx()
+    def _run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return get_io_pool().submit(_run)
 
 GCS_BUCKET_NAME = st.secrets.get("google_cloud_storage", {}).get("bucket_name", "")
-@st.cache_resource(ttl=3600)
+GCS_CHUNK_SIZE = 8 * _MB  # múltiplo de 256 KB, requisito de la API resumible
+@st.cache_resource
 def get_gcs_client():
-    creds = Credentials.from_service_account_info(st.secrets["google_service_account"], scopes=["https://www.googleapis.com/auth/cloud-platform"])
-    return storage.Client(project=st.secrets["google_service_account"]["project_id"], credentials=creds)
+    creds = get_sa_credentials()
+    session = mount_http_pool(AuthorizedSession(creds))
+    return storage.Client(project=st.secrets["google_service_account"]["project_id"], credentials=creds, _http=session)
+
+@st.cache_resource
+def get_gcs_bucket():
+    """Handle del bucket reutilizado entre subidas (misma sesión HTTP del cliente)."""
+    client = get_gcs_client()
+    return client.bucket(GCS_BUCKET_NAME) if client else None
+
+@st.cache_data(ttl="1h", max_entries=512, show_spinner=False)
+def _firmar_url(filename_in_bucket: str) -> str:
+    """URL firmada v4 de 7 días (límite máximo de Google).
+
+    Memoizada por nombre: con nombres por hash, la misma evidencia reenviada
+    reutiliza la URL en vez de volver a firmar. El TTL de 1 h deja intactos
+    casi los 7 días de vigencia.
+    """
+    return get_gcs_bucket().blob(filename_in_bucket).generate_signed_url(
+        version="v4",
+        expiration=timedelta(days=7),
+        method="GET",
+    )
 
 def upload_to_gcs(file_buffer, filename_in_bucket, content_type):
     """
-    Sube a GCS y devuelve URL firmada temporal válida por 7 días (compatible con UBLA/PAP).
+    Sube a GCS y devuelve (URL firmada válida por 7 días, error) (compatible con UBLA/PAP).
+
+    Si el objeto ya existía (mismo contenido subido antes) no se transfiere nada
+    y se devuelve la URL del existente.
     """
-    client = get_gcs_client()
-    if not client:
-        st.error("❌ No se puede subir a GCS: cliente no disponible.")
-        return None
     if not GCS_BUCKET_NAME:
-        st.error("❌ No se puede subir a GCS: falta google_cloud_storage.bucket_name en secrets.")
-        return None
+        return None, "❌ No se puede subir a GCS: falta google_cloud_storage.bucket_name en secrets."
+    bucket = get_gcs_bucket()
+    if not bucket:
+        return None, "❌ No se puede subir a GCS: cliente no disponible."
     try:
-        bucket = client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(filename_in_bucket)
-        
-        file_buffer.seek(0)
-        with_backoff(blob.upload_from_file, file_buffer, content_type=content_type, rewind=True)
-        
-        # --- CORRECCIÓN: 7 DÍAS (Límite máximo de Google) ---
-        signed_url = blob.generate_signed_url(
-            version="v4",
-            expiration=timedelta(days=7),  # <--- CAMBIADO A 7 DÍAS
-            method="GET",
-        )
-        
-        st.toast("☁️ Archivo subido (Link válido por 7 días).", icon="☁️")
-        return signed_url
+        # Hasta 8 MB (casi todas las imágenes): una sola petición multipart.
+        # Más grande (videos): chunk_size fuerza subida resumible en bloques de 8 MB,
+        # así un corte solo reenvía el bloque en curso.
+        size = getattr(file_buffer, "size", None)
+        grande = size is None or size > GCS_CHUNK_SIZE
+        blob = bucket.blob(filename_in_bucket, chunk_size=GCS_CHUNK_SIZE if grande else None)
+
+        # Si el navegador no manda MIME, lo deducimos por la extensión
+        content_type = content_type or mimetypes.guess_type(filename_in_bucket)[0] or "application/octet-stream"
+
+        # rewind=True solo hace seek(0): deja cada reintento de with_backoff empezar desde el inicio.
+        # if_generation_match=0 ("solo si no existe") hace idempotentes los reintentos:
+        # si un intento previo sí terminó, GCS responde 412 y no se duplica la subida.
+        # Con nombres por hash de contenido, el 412 también cubre evidencia repetida
+        # (en las resumibles llega al abrir la sesión, antes de enviar bytes).
+        # retry=None: con if_generation_match la librería activaría su propio
+        # reintento, anidado dentro de los de with_backoff.
+        try:
+            with_backoff(blob.upload_from_file, file_buffer, content_type=content_type, size=size,
+                         rewind=True, if_generation_match=0, timeout=120, retry=None)
+        except PreconditionFailed:
+            log.info(f"upload_to_gcs: '{filename_in_bucket}' ya existía, no se vuelve a subir")
+
+        signed_url = _firmar_url(filename_in_bucket)
+        return signed_url, None
     except Exception as e:
-        st.error(f"❌ Error al subir archivo a GCS: {e}")
-        return None
+        log.error(f"upload_to_gcs: error subiendo '{filename_in_bucket}': {e}")
+        return None, f"❌ Error al subir archivo a GCS: {e}"
+
+def subir_evidencia(file):
+    """Sube la evidencia con nombre por contenido: reenviar el mismo archivo no
+    lo vuelve a subir. Corre en el pool: el hash se calcula aquí, sobre
+    getbuffer() (sin copiar el archivo), y no en el hilo del script.
+
+    Los objetos nunca se borran al rechazar un ticket: con nombres por
+    contenido, el mismo objeto puede ser la evidencia de otro ticket aceptado.
+    Los huérfanos se dejan a la regla de ciclo de vida del bucket.
+    """
+    with file.getbuffer() as buf:
+        digest = hashlib.blake2b(buf, digest_size=16).hexdigest()
+    return upload_to_gcs(file, f"{digest}_{file.name}", file.type)
 # =========================
 # 🧠 CEREBRO IA (PORTERO V3.2 - Checklist)
 # =========================
@@ -133,35 +206,74 @@ def get_openai_client():
     key = st.secrets.get("openai", {}).get("api_key")
     return openai.OpenAI(api_key=key) if key else None
 
-@st.cache_data
-def cargar_manual_pdf(ruta="manual.pdf"):
+MANUAL_TXT_CACHE = Path("data") / "manual.txt"
+
+def _texto_manual(ruta) -> str:
+    """Texto plano del PDF; se reutiliza data/manual.txt mientras el PDF no cambie (mtime)."""
+    if MANUAL_TXT_CACHE.exists() and MANUAL_TXT_CACHE.stat().st_mtime >= os.path.getmtime(ruta):
+        return MANUAL_TXT_CACHE.read_text(encoding="utf-8")
+    texto = "\n".join(filter(None, (p.extract_text() for p in PdfReader(ruta).pages)))
+    try:
+        MANUAL_TXT_CACHE.write_text(texto, encoding="utf-8")
+    except OSError as e:
+        log.warning(f"cargar_manual_pdf: no se pudo guardar '{MANUAL_TXT_CACHE}': {e}")
+    return texto
+
+@st.cache_data(show_spinner=False)
+def cargar_manual_pdf(ruta="Manual.pdf"):
+    # En memoria por proceso; entre reinicios el texto sale de data/manual.txt
     chunks = []
-    if os.path.exists(ruta):
+    if not os.path.exists(ruta):
+        log.warning(f"cargar_manual_pdf: no existe '{ruta}', el validador va sin contexto del manual")
+    else:
         try:
-            reader = PdfReader(ruta)
-            texto = "".join([p.extract_text() for p in reader.pages])
-            for i in range(0, len(texto), 1000):
-                chunks.append(f"[MANUAL]: {texto[i:i+1000]}")
+            texto = _texto_manual(ruta)
+            chunks = [f"[MANUAL]: {texto[i:i+1000]}" for i in range(0, len(texto), 1000)]
         except Exception as e: log.warning(f"cargar_manual_pdf: error leyendo '{ruta}': {e}")
     return chunks
 
-def validar_incidencia_con_ia(asunto, descripcion, categoria, link, tiene_adjunto):
-    client = get_openai_client()
-    if not client: return True, "" 
-    
-    manual = cargar_manual_pdf("manual.pdf")
-    contexto = "\n".join(manual[:6]) if manual else ""
-    adjunto_str = "CON_ARCHIVO" if tiene_adjunto else "SIN_ARCHIVO"
+# Salida estructurada estricta: el modelo solo puede devolver estos dos campos
+VALIDACION_SCHEMA = {
+    "name": "validacion_ticket",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "valido": {"type": "boolean"},
+            "razon_corta": {"type": "string"},
+        },
+        "required": ["valido", "razon_corta"],
+        "additionalProperties": False,
+    },
+}
+
+UAG_ID_RE = re.compile(r"\b\d{7,8}\b")
+# Categorías cuyo checklist se resuelve completo con _rule_check (sin IA)
+CATEGORIAS_SOLO_REGLAS = {"Desfase", "Llamadas"}
+
+def _rule_check(categoria, asunto, descripcion, link, tiene_adjunto) -> tuple[bool, str]:
+    """Reglas deterministas del checklist; evita la llamada a OpenAI en los rechazos obvios."""
+    requiere_link = categoria in ("Reactivación", "Desfase", "Equivalencia")
+    if requiere_link and "zoho.com" not in (link or "").lower():
+        return False, "Falta el link del registro en Zoho CRM."
+    if categoria == "Desfase" and not UAG_ID_RE.search(f"{asunto} {descripcion}"):
+        return False, "Falta el ID UAG (7 u 8 dígitos) en el asunto o la descripción."
+    if categoria in ("Desfase", "Llamadas") and not tiene_adjunto:
+        return False, "Falta adjuntar la evidencia (imagen o video)."
+    return True, ""
 
-    prompt = f"""
-    Eres el Validador de Calidad de Zoho CRM. Tu misión es aprobar o rechazar tickets basándote ESTRICTAMENTE en los datos siguientes.
+@st.cache_data(show_spinner=False)
+def _build_system_prompt() -> str:
+    """Parte estática del prompt (reglas + extracto del manual).
 
-    DATOS DEL TICKET:
-    - Categoría: {categoria}
-    - Asunto: {asunto}
-    - Descripción: {descripcion}
-    - Link: {link}
-    - Estado del Adjunto: {adjunto_str}
+    Va como mensaje `system` y es idéntica en cada llamada, así que OpenAI
+    la reutiliza con su caché automático de prefijos; solo los datos del
+    ticket viajan en el mensaje `user`.
+    """
+    manual = cargar_manual_pdf("Manual.pdf")
+    contexto = "\n".join(manual[:6]) if manual else ""
+    return f"""
+    Eres el Validador de Calidad de Zoho CRM. Tu misión es aprobar o rechazar tickets basándote ESTRICTAMENTE en los datos del ticket que recibirás.
 
     REGLAS DE VALIDACIÓN (CHECKLIST):
     1. SI CATEGORÍA ES 'Reactivación':
@@ -185,14 +297,60 @@ def validar_incidencia_con_ia(asunto, descripcion, categoria, link, tiene_adjunt
     Evalúa los puntos arriba.
     Si todo cumple, responde {{"valido": true, "razon_corta": ""}}.
     Si algo falla, responde {{"valido": false, "razon_corta": "Indica exactamente qué faltó."}}.
+
+    CONTEXTO DEL MANUAL:
+    {contexto}
+    """
+
+class IATruncada(Exception):
+    """El veredicto de la IA se cortó por max_tokens: no se puede leer."""
+
+@st.cache_data(ttl="1h", max_entries=256, show_spinner=False)
+def _consultar_ia(datos_ticket: str) -> tuple[bool, str]:
+    """Llamada a OpenAI memoizada por el texto del ticket: un reenvío idéntico
+    (doble clic, reintento tras un rechazo) no vuelve a pagar la consulta.
+    Los errores se propagan para que no queden cacheados.
+    """
+    # Si la respuesta se corta en 80 tokens, un reintento con más margen
+    for max_tokens in (80, 240):
+        choice = get_openai_client().chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": _build_system_prompt()},
+                {"role": "user", "content": datos_ticket},
+            ],
+            response_format={"type": "json_schema", "json_schema": VALIDACION_SCHEMA},
+            max_tokens=max_tokens, temperature=0.0
+        ).choices[0]
+        if choice.finish_reason != "length":
+            break
+        log.warning(f"_consultar_ia: respuesta cortada con max_tokens={max_tokens}")
+    else:
+        raise IATruncada()
+    data = json.loads(choice.message.content)
+    return data.get("valido", True), data.get("razon_corta", "")
+
+def validar_incidencia_con_ia(asunto, descripcion, categoria, link, tiene_adjunto):
+    ok, razon = _rule_check(categoria, asunto, descripcion, link, tiene_adjunto)
+    if not ok or categoria in CATEGORIAS_SOLO_REGLAS:
+        return ok, razon
+
+    if not get_openai_client(): return True, ""
+
+    adjunto_str = "CON_ARCHIVO" if tiene_adjunto else "SIN_ARCHIVO"
+    datos_ticket = f"""
+    DATOS DEL TICKET:
+    - Categoría: {categoria}
+    - Asunto: {asunto}
+    - Descripción: {descripcion}
+    - Link: {link}
+    - Estado del Adjunto: {adjunto_str}
     """
     try:
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini", messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"}, temperature=0.0
-        )
-        data = json.loads(resp.choices[0].message.content)
-        return data.get("valido", True), data.get("razon_corta", "")
+        return _consultar_ia(datos_ticket)
+    except IATruncada:
+        # Un veredicto ilegible no aprueba: se rechaza sin cachear (el reenvío vuelve a consultar)
+        return False, "No se pudo validar el ticket. Revisa los datos e inténtalo de nuevo."
     except Exception as e:
         log.warning(f"validar_incidencia_con_ia: error llamando OpenAI, validación omitida: {e}")
         return True, ""
@@ -201,9 +359,27 @@ def validar_incidencia_con_ia(asunto, descripcion, categoria, link, tiene_adjunt
 # Datos y Funciones Aux
 # =========================
 data_folder = Path("data")
-estructura_roles = load_json_safe(data_folder / "estructura_roles.json")
-numeros_por_rol  = load_json_safe(data_folder / "numeros_por_rol.json")
-horarios_dict    = load_json_safe(data_folder / "horarios.json")
+
+@st.cache_resource
+def _cargar_catalogos():
+    """Lee los JSON de data/ una vez por proceso (el script se re-ejecuta en cada interacción).
+    Se comparten entre sesiones: tratarlos como solo lectura.
+    """
+    return (
+        load_json_safe(data_folder / "estructura_roles.json"),
+        load_json_safe(data_folder / "numeros_por_rol.json"),
+        load_json_safe(data_folder / "horarios.json"),
+    )
+
+estructura_roles, numeros_por_rol, horarios_dict = _cargar_catalogos()
+
+# Opciones de la cascada Área → Perfil → Rol, precalculadas una sola vez
+_SEL = "Selecciona..."
+AREAS = (_SEL,) + tuple(estructura_roles)
+PERFILES_BY_AREA = {a: (_SEL,) + tuple(pp) for a, pp in estructura_roles.items()}
+ROLES_BY_AP = {(a, p): (_SEL,) + tuple(r) for a, pp in estructura_roles.items() for p, r in pp.items()}
+HORARIOS = (_SEL,) + tuple(horarios_dict)
+AREA_IDX = {a: i for i, a in enumerate(AREAS)}
 
 if "usuario_logueado" not in st.session_state: st.session_state.usuario_logueado = None
 
@@ -212,72 +388,359 @@ if "usuario_logueado" not in st.session_state: st.session_state.usuario_logueado
 # =========================
 # ⭐ AUTO-CALIFICACIÓN (3 días sin calificar → 👍)
 # =========================
+def _auto_calificar_hoja(ws, sheet_name, c_fecha, c_estado, c_calif, corte):
+    """Pone 👍 en `c_calif` de las filas "Atendido" sin calificar con fecha <= corte.
+
+    Filtra con operaciones de columna (sin recorrer filas en Python). Lee la hoja
+    en fresco, no del caché: los números de fila tienen que ser los actuales.
+    """
+    # Encabezados de la misma lectura: las posiciones de columna también tienen que ser las actuales
+    v = with_backoff(ws.get_all_values)
+    header = v[0] if v else []
+    if not all(c in header for c in (c_fecha, c_estado, c_calif)):
+        return
+    df = _values_to_df(v)
+    if df.empty:
+        return
+    # Acceso posicional: tolera encabezados repetidos en la hoja
+    estado = df.iloc[:, header.index(c_estado)]
+    calif  = df.iloc[:, header.index(c_calif)]
+    fecha  = pd.to_datetime(df.iloc[:, header.index(c_fecha)], format="%d/%m/%Y %H:%M:%S", errors="coerce")
+
+    pendientes = estado.eq("Atendido") & calif.str.strip().eq("")
+    invalidas = pendientes & fecha.isna()
+    if invalidas.any():
+        filas = (invalidas[invalidas].index + 2).tolist()
+        log.warning(f"auto_calificar_vencidos: fecha inválida en {sheet_name} filas {filas}")
+    vencidas = pendientes & (fecha <= corte)
+
+    col = header.index(c_calif) + 1
+    updates = [{"range": rowcol_to_a1(i + 2, col), "values": [["👍"]]} for i in vencidas[vencidas].index]
+    if updates:
+        with_backoff(ws.batch_update, updates)
+        clear_records_cache()   # invalidar caché
+
 def auto_calificar_vencidos():
     """
     Revisa Sheet1 (col Q = CalificacionS) e Incidencias (col J = SatisfaccionI).
     Si llevan más de 3 días en "Atendido" sin calificación, pone 👍 automáticamente.
-    Se ejecuta silenciosamente cada vez que carga la app.
     """
-    limite = timedelta(days=3)
-    ahora  = datetime.now(TZ_MX)
+    # Las fechas de la hoja son hora local de MX sin zona: se comparan sin tzinfo
+    corte = datetime.now(TZ_MX).replace(tzinfo=None) - timedelta(days=3)
+    for ws, nombre, cols in [
+        (sheet_solicitudes, "Sheet1", ("FechaS", "EstadoS", "CalificacionS")),
+        (sheet_incidencias, "Incidencias", ("FechaI", "EstadoI", "SatisfaccionI")),
+    ]:
+        try:
+            _auto_calificar_hoja(ws, nombre, *cols, corte)
+        except Exception as e:
+            log.warning(f"auto_calificar_vencidos: error procesando {nombre}: {e}")
 
-    # --- SHEET1: Solicitudes ---
-    try:
-        header_s = sheet_solicitudes.row_values(1)
-        if "FechaS" in header_s and "EstadoS" in header_s and "CalificacionS" in header_s:
-            col_fecha  = header_s.index("FechaS") + 1
-            col_estado = header_s.index("EstadoS") + 1
-            col_calif  = header_s.index("CalificacionS") + 1   # columna Q
-
-            all_rows = sheet_solicitudes.get_all_values()[1:]   # sin encabezado
-            updates  = []
-            for i, row in enumerate(all_rows):
-                estado = row[col_estado - 1] if len(row) >= col_estado else ""
-                calif  = row[col_calif  - 1] if len(row) >= col_calif  else ""
-                fecha  = row[col_fecha  - 1] if len(row) >= col_fecha  else ""
-                if estado == "Atendido" and not calif.strip():
-                    try:
-                        fecha_dt = datetime.strptime(fecha, "%d/%m/%Y %H:%M:%S")
-                        fecha_dt = fecha_dt.replace(tzinfo=TZ_MX)
-                        if ahora - fecha_dt >= limite:
-                            updates.append({"range": rowcol_to_a1(i + 2, col_calif), "values": [["👍"]]})
-                    except Exception as e:
-                        log.warning(f"auto_calificar_vencidos: fecha inválida en Sheet1 fila {i+2}: {e}")
-            if updates:
-                sheet_solicitudes.batch_update(updates)
-                get_records_simple.clear()   # invalidar caché
-    except Exception as e:
-        log.warning(f"auto_calificar_vencidos: error procesando Sheet1: {e}")
+# auto_calificar_vencidos() — se ejecuta desde el botón en Admin
 
-    # --- INCIDENCIAS ---
-    try:
-        header_i = sheet_incidencias.row_values(1)
-        if "FechaI" in header_i and "EstadoI" in header_i and "SatisfaccionI" in header_i:
-            col_fecha  = header_i.index("FechaI") + 1
-            col_estado = header_i.index("EstadoI") + 1
-            col_calif  = header_i.index("SatisfaccionI") + 1    # columna J
-
-            all_rows = sheet_incidencias.get_all_values()[1:]
-            updates  = []
-            for i, row in enumerate(all_rows):
-                estado = row[col_estado - 1] if len(row) >= col_estado else ""
-                calif  = row[col_calif  - 1] if len(row) >= col_calif  else ""
-                fecha  = row[col_fecha  - 1] if len(row) >= col_fecha  else ""
-                if estado == "Atendido" and not calif.strip():
+# =========================
+# 🔐 ADMIN: pestañas como fragmentos
+# =========================
+# Cada pestaña es un @st.fragment: al interactuar con sus widgets solo se
+# re-ejecuta esa pestaña (y solo esa hoja se consulta), no el script completo.
+
+_ADMIN_PASS = st.secrets.get("admin", {}).get("password", "")
+
+# Opciones de estado y su posición, para el index= de los selectbox
+ESTADOS = ("Pendiente", "En proceso", "Atendido")
+ESTADO_IDX = {e: i for i, e in enumerate(ESTADOS)}
+ESTADOS_Q = ("Pendiente", "Aprobado", "Rechazado", "En Revisión", "Atendido")
+ESTADO_Q_IDX = {e: i for i, e in enumerate(ESTADOS_Q)}
+
+ADMIN_TABLA_MAX = 200
+
+def _tabla_admin(df: pd.DataFrame, key: str):
+    """Muestra solo los últimos ADMIN_TABLA_MAX registros salvo que se pida todo:
+    la tabla completa se serializa al navegador en cada rerun del fragmento.
+    """
+    if len(df) > ADMIN_TABLA_MAX and not st.checkbox(f"Ver todas ({len(df)})", key=f"ver_todas_{key}"):
+        st.dataframe(df.tail(ADMIN_TABLA_MAX), use_container_width=True)
+        st.caption(f"Mostrando los últimos {ADMIN_TABLA_MAX} de {len(df)} registros.")
+    else:
+        st.dataframe(df, use_container_width=True)
+
+def _fila_por_id(df: pd.DataFrame, col: str) -> dict:
+    """ID → número de fila en la hoja (fila 1 = encabezados).
+
+    El DataFrame viene de get_all_values/batchGet sin filtrar, así que la
+    posición i corresponde a la fila i + 2 (y df.iloc[fila - 2] es el
+    registro). Con IDs repetidos gana el primero, igual que sheet.find.
+    """
+    filas = {}
+    for i, v in enumerate(df[col].tolist()):
+        if v:
+            filas.setdefault(v, i + 2)
+    return filas
+
+def _fila_vigente(ws, sheet_name: str, col_id: str, id_, fila_por_id: dict):
+    """Número de fila actual de `id_`, comprobado contra la hoja antes de escribir.
+
+    fila_por_id sale del caché (hasta 60 s): si alguien movió filas desde
+    entonces, en esa fila ya hay otro registro. Se relee la celda del ID y,
+    si no coincide, se busca con find() como antes. None si ya no existe.
+    """
+    fila = fila_por_id.get(id_)
+    if fila and ids_en_filas(ws, sheet_name, col_id, [fila]) == [id_]:
+        return fila
+    # El caché ya no refleja la hoja: registros y encabezados se vuelven a leer,
+    # así find() y las columnas que usa el llamador salen de la hoja actual
+    clear_records_cache()
+    clear_headers_cache()
+    log.warning(f"_fila_vigente: '{id_}' ya no está en la fila {fila} de {sheet_name}, buscando con find()")
+    cell = with_backoff(ws.find, id_, in_column=get_col_idx(sheet_name)[col_id])
+    if not cell:
+        st.error(f"⚠️ El registro {id_} ya no está en la hoja. Recarga la tabla.")
+        return None
+    return cell.row
+
+def _borrar_varios(ws, sheet_name: str, col_id: str, ids: list, fila_por_id: dict, key: str):
+    """Limpieza masiva: todas las filas marcadas se borran en una sola llamada.
+
+    Antes de borrar se releen los IDs de esas filas: si alguna ya no tiene el
+    registro marcado (la hoja cambió desde el caché), no se borra ninguna.
+    """
+    with st.expander("🗑️ Eliminar varios"):
+        marcados = st.multiselect("Marcar para borrar", ids, key=f"borrar_{key}")
+        if marcados and st.button(f"Eliminar seleccionados ({len(marcados)})", key=f"btn_borrar_{key}"):
+            filas = [fila_por_id[i] for i in marcados]
+            if ids_en_filas(ws, sheet_name, col_id, filas) != marcados:
+                # El caché ya no refleja la hoja: el siguiente intento relee registros y encabezados
+                clear_records_cache()
+                clear_headers_cache()
+                st.error("⚠️ La hoja cambió desde la última carga; no se borró nada. Revisa la selección.")
+                return
+            delete_rows_batch(ws, filas)
+            clear_records_cache()   # invalidar caché
+            st.session_state.pop(f"borrar_{key}", None)
+            st.toast(f"🗑️ {len(marcados)} eliminados"); st.rerun(scope="fragment")
+
+@st.fragment
+def render_solicitudes_tab():
+    lista_supervisores = list(st.secrets["admin"]["emails"])  # CC en correos
+    st.subheader("Gestión de Solicitudes")
+    with st.spinner("Cargando..."):
+        dfs = get_records_simple(sheet_solicitudes, "Sheet1")
+
+    if dfs.empty:
+        st.warning("⚠️ No hay datos o conexión lenta.")
+    else:
+        _tabla_admin(dfs, "sol")
+
+        # Buscamos la columna IDS (Clave única)
+        col_id_name = "IDS" if "IDS" in dfs.columns else "ID"
+
+        if col_id_name in dfs.columns:
+            ids = dfs.loc[dfs[col_id_name] != "", col_id_name].unique().tolist()
+            fila_por_id = _fila_por_id(dfs, col_id_name)
+            if ids:
+                st.divider()
+                # Selector en la ÚLTIMA solicitud
+                idx_def = len(ids)-1 if len(ids) > 0 else 0
+                sel_id = st.selectbox("ID Solicitud", ids, index=idx_def)
+
+                row_s = dfs.iloc[fila_por_id[sel_id] - 2]
+
+                st.info(f"**{row_s.get('TipoS')}** - {row_s.get('NombreS')} ({row_s.get('CorreoS')})")
+                st.caption(f"Solicitado por: {row_s.get('SolicitanteS')}")
+
+                c_st, _ = st.columns(2)
+                st_act = row_s.get("EstadoS", "Pendiente")
+                nuevo_estado = c_st.selectbox("Estado", ESTADOS, index=ESTADO_IDX.get(st_act, 0), key="st_sol_main")
+
+                # Guardamos en CredencialesZohoS
+                val_resp = row_s.get("CredencialesZohoS", "")
+                mensaje_respuesta = st.text_area("Resolución / Credenciales", value=val_resp, key="resp_sol_main")
+
+                c1, c2 = st.columns(2)
+                if c1.button("💾 Actualizar Solicitud"):
+                    row_n = _fila_vigente(sheet_solicitudes, "Sheet1", col_id_name, sel_id, fila_por_id)
+                    if row_n:
+                        cols = get_col_idx("Sheet1")
+                        try:
+                            # Buscamos índices dinámicamente
+                            col_st = cols["EstadoS"]
+                            col_cred = cols["CredencialesZohoS"]
+
+                            # Una sola escritura para estado + respuesta
+                            with_backoff(sheet_solicitudes.batch_update, [
+                                {"range": rowcol_to_a1(row_n, col_st), "values": [[nuevo_estado]]},
+                                {"range": rowcol_to_a1(row_n, col_cred), "values": [[mensaje_respuesta]]},
+                            ], value_input_option="USER_ENTERED")
+                            clear_records_cache()   # invalidar caché
+
+                            # Correo al SolicitanteS
+                            correo_sol = row_s.get("SolicitanteS")
+                            if SEND_EMAILS and nuevo_estado == "Atendido" and mensaje_respuesta and correo_sol:
+                                try:
+                                    html = render(TPL_SOLICITUD_ATENDIDA,
+                                        tipo=row_s.get('TipoS'), nombre=row_s.get('NombreS'), respuesta=mensaje_respuesta)
+                                    send_mail_async(to=correo_sol, cc=lista_supervisores, subject=f"✅ Finalizado: {row_s.get('TipoS')}", contents=[html], headers=remitente())
+                                    st.toast("📧 Notificación en camino.")
+                                except Exception as e: st.error(f"Error correo: {e}")
+
+                            st.toast("✅ Actualizado"); st.rerun(scope="fragment")
+                        except Exception as e: st.error(f"Error columnas Excel: {e}")
+
+                if c2.button("🗑️ Eliminar Solicitud"):
+                    row_n = _fila_vigente(sheet_solicitudes, "Sheet1", col_id_name, sel_id, fila_por_id)
+                    if row_n:
+                        with_backoff(sheet_solicitudes.delete_rows, row_n)
+                        clear_records_cache()   # invalidar caché
+                        st.toast("🗑️ Eliminado"); st.rerun(scope="fragment")
+
+                _borrar_varios(sheet_solicitudes, "Sheet1", col_id_name, ids, fila_por_id, "sol")
+
+@st.fragment
+def render_incidencias_tab():
+    st.subheader("Gestión de Incidencias")
+    with st.spinner("Cargando..."):
+        dfi = get_records_simple(sheet_incidencias, "Incidencias")
+
+    if dfi.empty:
+        st.warning("⚠️ No hay datos.")
+    else:
+        _tabla_admin(dfi, "inc")
+        if "IDI" in dfi.columns:
+            ids_i = dfi.loc[dfi["IDI"] != "", "IDI"].unique().tolist()
+            fila_por_id = _fila_por_id(dfi, "IDI")
+            if ids_i:
+                st.divider()
+                idx_def_i = len(ids_i)-1 if len(ids_i) > 0 else 0
+                sel_idi = st.selectbox("ID Incidencia", ids_i, index=idx_def_i, key="sel_inc")
+                row_i = dfi.iloc[fila_por_id[sel_idi] - 2]
+
+                st.info(f"**{row_i.get('Asunto')}** | {row_i.get('CorreoI')}")
+
+                # --- BOTÓN DE IA (RAG) ---
+                if st.button("✨ Sugerir Respuesta (IA)"):
+                    # Nota: Asegúrate de tener la función 'generar_respuesta_ia' definida o importada
+                    # Si no la tienes en este archivo, comenta estas líneas para evitar error.
                     try:
-                        fecha_dt = datetime.strptime(fecha, "%d/%m/%Y %H:%M:%S")
-                        fecha_dt = fecha_dt.replace(tzinfo=TZ_MX)
-                        if ahora - fecha_dt >= limite:
-                            updates.append({"range": rowcol_to_a1(i + 2, col_calif), "values": [["👍"]]})
-                    except Exception as e:
-                        log.warning(f"auto_calificar_vencidos: fecha inválida en Incidencias fila {i+2}: {e}")
-            if updates:
-                sheet_incidencias.batch_update(updates)
-                get_records_simple.clear()
-    except Exception as e:
-        log.warning(f"auto_calificar_vencidos: error procesando Incidencias: {e}")
+                        with st.spinner("Leyendo manual y casos previos..."):
+                            st.session_state.rag = generar_respuesta_ia(row_i.get("Asunto"), row_i.get("DescripcionI"), dfi)
+                    except NameError:
+                        st.warning("La función de IA RAG no está definida en este contexto.")
+
+                c_st_i, _ = st.columns(2)
+                st_act_i = row_i.get("EstadoI", "Pendiente")
+                nuevo_estado_i = c_st_i.selectbox("Estado", ESTADOS, index=ESTADO_IDX.get(st_act_i, 0), key="st_inc_main")
+
+                val_rag = st.session_state.get("rag", row_i.get("RespuestadeSolicitudI",""))
+                respuesta = st.text_area("Respuesta Técnica", value=val_rag, key="resp_inc_main")
+
+                c1, c2 = st.columns(2)
+                if c1.button("💾 Responder Incidencia"):
+                    row_n = _fila_vigente(sheet_incidencias, "Incidencias", "IDI", sel_idi, fila_por_id)
+                    if row_n:
+                        cols = get_col_idx("Incidencias")
+                        col_st = cols["EstadoI"]
+                        col_resp = cols["RespuestadeSolicitudI"]
+                        # Una sola escritura para estado + respuesta
+                        with_backoff(sheet_incidencias.batch_update, [
+                            {"range": rowcol_to_a1(row_n, col_st), "values": [[nuevo_estado_i]]},
+                            {"range": rowcol_to_a1(row_n, col_resp), "values": [[respuesta]]},
+                        ], value_input_option="USER_ENTERED")
+                        clear_records_cache()   # invalidar caché
+
+                        correo_usu = row_i.get("CorreoI")
+                        if SEND_EMAILS and nuevo_estado_i == "Atendido" and respuesta and correo_usu:
+                            try:
+                                html = render(TPL_INCIDENCIA_RESUELTA, asunto=row_i.get('Asunto'), respuesta=respuesta)
+                                lista_supervisores = list(st.secrets["admin"]["emails"])
+                                send_mail_async(to=correo_usu, cc=lista_supervisores, subject=f"✅ Resuelto: {row_i.get('Asunto')}", contents=[html], headers=remitente())
+                                st.toast("📧 Notificación en camino.")
+                            except Exception as e:
+                                log.error(f"tab2_responder_incidencia: error enviando correo a {correo_usu}: {e}")
+                        st.toast("✅ Actualizado"); st.rerun(scope="fragment")
+
+                if c2.button("🗑️ Eliminar Incidencia"):
+                    row_n = _fila_vigente(sheet_incidencias, "Incidencias", "IDI", sel_idi, fila_por_id)
+                    if row_n:
+                        with_backoff(sheet_incidencias.delete_rows, row_n)
+                        clear_records_cache()   # invalidar caché
+                        st.toast("🗑️ Eliminado"); st.rerun(scope="fragment")
+
+                _borrar_varios(sheet_incidencias, "Incidencias", "IDI", ids_i, fila_por_id, "inc")
+
+@st.fragment
+def render_quejas_tab():
+    st.subheader("Gestión de Accesos, Quejas y Sugerencias")
+
+    # Leemos de QUEJAS
+    dfq = get_records_simple(sheet_quejas, "Quejas")
+
+    if dfq.empty:
+        st.info("No hay registros pendientes.")
+    else:
+        _tabla_admin(dfq, "quejas")
+
+        # Buscamos la columna ID (En tu hoja Quejas suele ser IDQ o ID)
+        # Ajusta "IDQ" si así se llama en tu Excel, o "ID" si es genérico.
+        col_id_target = "IDQ" if "IDQ" in dfq.columns else "ID"
+
+        if col_id_target in dfq.columns:
+            ids_q = dfq.loc[dfq[col_id_target] != "", col_id_target].unique().tolist()
+            fila_por_id = _fila_por_id(dfq, col_id_target)
+
+            if ids_q:
+                st.divider()
+                # Selector inteligente
+                sel_id_q = st.selectbox("Seleccionar Registro", ids_q, format_func=lambda x: f"{x} - {dfq.iloc[fila_por_id[x] - 2].get('TipoQ', 'Registro')}")
+
+                row_q = dfq.iloc[fila_por_id[sel_id_q] - 2]
+
+                # Nombres de columnas basados en tu hoja Quejas (ajusta si difieren)
+                tipo_val = row_q.get('TipoQ') or row_q.get('Tipo')
+                correo_val = row_q.get('CorreoQ') or row_q.get('Correo')
+                desc_val = row_q.get('DescripciónQ') or row_q.get('Justificacion') or row_q.get('Detalle')
+                estado_val = row_q.get('EstadoQ') or row_q.get('Estado') or "Pendiente"
+                resp_val = row_q.get('RespuestaQ') or row_q.get('RespuestaAdmin') or ""
+
+                st.markdown(f"**Tipo:** {tipo_val} | **Solicitante:** {correo_val}")
+                st.warning(f"**Detalle:** {desc_val}")
+
+                c_st_q, _ = st.columns(2)
+                nuevo_estado = c_st_q.selectbox("Estado", ESTADOS_Q, index=ESTADO_Q_IDX.get(estado_val, 0), key="st_fusion_q")
+                nueva_resp = st.text_area("Respuesta Admin", value=resp_val, key="rsp_fusion_q")
+
+                if st.button("💾 Guardar Cambios"):
+                    row_n = _fila_vigente(sheet_quejas, "Quejas", col_id_target, sel_id_q, fila_por_id)
+                    if row_n:
+                        cols_q = get_col_idx("Quejas")
+                        _estado_col = next((c for c in ["EstadoQ", "Estado"] if c in cols_q), None)
+                        _resp_col   = next((c for c in ["RespuestaQ", "RespuestaAdmin"] if c in cols_q), None)
+                        updates_q = []
+                        if _estado_col:
+                            updates_q.append({"range": rowcol_to_a1(row_n, cols_q[_estado_col]), "values": [[nuevo_estado]]})
+                        else:
+                            log.error("tab3: columna Estado no encontrada en sheet_quejas")
+                        if _resp_col:
+                            updates_q.append({"range": rowcol_to_a1(row_n, cols_q[_resp_col]), "values": [[nueva_resp]]})
+                        else:
+                            log.error("tab3: columna Respuesta no encontrada en sheet_quejas")
+                        _updated = bool(updates_q)
+                        if _updated:
+                            with_backoff(sheet_quejas.batch_update, updates_q, value_input_option="USER_ENTERED")
+
+                        if _updated:
+                            clear_records_cache()   # invalidar caché
+                            # Notificar
+                            if SEND_EMAILS and nuevo_estado in ["Aprobado", "Rechazado", "Atendido"]:
+                                asunto_mail = f"Actualización: {tipo_val}"
+                                body_mail = render(TPL_ACTUALIZACION, estado=nuevo_estado, respuesta=nueva_resp)
+                                try:
+                                    send_mail_async(to=correo_val, subject=asunto_mail, contents=[body_mail])
+                                    st.toast("📧 Notificación en camino.")
+                                except Exception as e:
+                                    log.error(f"tab3_guardar_cambios: error enviando correo a {correo_val}: {e}")
 
-# auto_calificar_vencidos() — se ejecuta desde el botón en Admin
+                            st.toast("✅ Registro actualizado.")
+                            st.rerun(scope="fragment")
 
 # ---------------------------------------------------------
 # BLOQUE DE NAVEGACIÓN (Este debe ir ANTES de cualquier 'if seccion')
@@ -304,16 +767,21 @@ if seccion == "🔍 Ver el estado de mis solicitudes":
     if not st.session_state.usuario_logueado:
         if st.session_state.pop("login_error", False):
             st.error("❌ Contraseña incorrecta. Inténtalo de nuevo.")
-        with st.form("log", clear_on_submit=True):
+        login_box = st.empty()
+        with login_box.form("log", clear_on_submit=True):
             pw = st.text_input("Contraseña", type="password")
             if st.form_submit_button("Entrar"):
-                udict = get_usuarios_dict()
-                if pw.strip() in udict:
-                    do_login(udict[pw.strip()])
+                correo = buscar_usuario(pw)
+                if correo:
+                    # Sin st.rerun(): se quita el form y los tickets se pintan en esta misma pasada
+                    do_login(correo, rerun=False)
                 else:
                     st.session_state["login_error"] = True
                     st.rerun()
-    else:
+        if st.session_state.usuario_logueado:
+            login_box.empty()
+
+    if st.session_state.usuario_logueado:
         st.info(f"Usuario: **{st.session_state.usuario_logueado}**")
         if st.button("Salir"): do_logout()
         
@@ -324,12 +792,12 @@ if seccion == "🔍 Ver el estado de mis solicitudes":
         # Verificamos si existe la columna "SolicitanteS" y filtramos
         if not dfs.empty and "SolicitanteS" in dfs.columns:
             # Filtramos donde el solicitante sea el usuario logueado
-            dfms = dfs[dfs["SolicitanteS"].map(_email_norm) == st.session_state.usuario_logueado]
+            dfms = dfs[email_norm_series(dfs["SolicitanteS"]) == st.session_state.usuario_logueado]
             
             if dfms.empty:
                 st.caption("No tienes solicitudes registradas.")
             else:
-                for i, r in dfms.iterrows():
+                for r in dfms.to_dict("records"):
                     color = "orange" if r.get('EstadoS') == "Pendiente" else "green"
                     with st.expander(f"{r.get('TipoS')} - {r.get('NombreS')} (:{color}[{r.get('EstadoS')}])"):
                         st.write(f"**Fecha:** {r.get('FechaS')}")
@@ -345,12 +813,12 @@ if seccion == "🔍 Ver el estado de mis solicitudes":
         st.subheader("🛠️ Mis Incidencias (Soporte)")
         dfi = get_records_simple(sheet_incidencias, "Incidencias")
         if not dfi.empty and "CorreoI" in dfi.columns:
-            dfmi = dfi[dfi["CorreoI"].map(_email_norm) == st.session_state.usuario_logueado]
+            dfmi = dfi[email_norm_series(dfi["CorreoI"]) == st.session_state.usuario_logueado]
             
             if dfmi.empty:
                 st.caption("No tienes incidencias registradas.")
             else:
-                for i, r in dfmi.iterrows():
+                for r in dfmi.to_dict("records"):
                     color = "orange" if r.get('EstadoI') == "Pendiente" else "green"
                     with st.expander(f"{r.get('Asunto')} (:{color}[{r.get('EstadoI')}])"):
                         st.write(f"**Descripción:** {r.get('DescripcionI')}")
@@ -359,228 +827,230 @@ if seccion == "🔍 Ver el estado de mis solicitudes":
 
 # ===================== SECCIÓN: SOLICITUDES CRM =====================
 elif seccion == "🌟 Solicitudes CRM":
-    st.markdown("## 🌟 Formulario de Solicitudes Zoho CRM")
-
-    # --- Estado de sesión para los dropdowns ---
-    ss = st.session_state
-    defaults = {
-        "sol_tipo": "Selecciona...", "sol_area": "Selecciona...",
-        "sol_perfil": "Selecciona...", "sol_rol": "Selecciona...",
-        "sol_horario": "Selecciona...", "sol_turno": "",
-        "sol_num_in": "No aplica", "sol_num_out": "No aplica",
-    }
-
-    # --- 🟢 LÓGICA DE RESETEO (SOLUCIÓN AL ERROR) ---
-    # Esto se ejecuta AL PRINCIPIO de la recarga, antes de dibujar los widgets.
-    if ss.get("reset_solicitud_flag"):
-        for k in defaults:
-            if k != "sol_tipo": ss[k] = defaults[k]
-        del ss["reset_solicitud_flag"] # Apagamos la bandera
-        st.success("✅ Solicitud registrada y enviada correctamente."); st.balloons()
-    # ----------------------------------------------------
-
-    for k, v in defaults.items():
-        if k not in ss: ss[k] = v
-
-    # --- Callbacks para resetear dropdowns en cascada ---
-    def on_change_area():
-        ss.sol_perfil = "Selecciona..."
-        ss.sol_rol = "Selecciona..."
-        ss.sol_horario = "Selecciona..."
-        ss.sol_turno = ""
+    # Toda la sección es un fragmento: los dropdowns en cascada y el submit
+    # solo re-ejecutan este formulario, no el script completo.
+    @st.fragment
+    def _solicitudes_section():
+        st.markdown("## 🌟 Formulario de Solicitudes Zoho CRM")
+
+        # --- Estado de sesión para los dropdowns ---
+        ss = st.session_state
+        defaults = {
+            "sol_tipo": "Selecciona...", "sol_area": "Selecciona...",
+            "sol_perfil": "Selecciona...", "sol_rol": "Selecciona...",
+            "sol_horario": "Selecciona...", "sol_turno": "",
+            "sol_num_in": "No aplica", "sol_num_out": "No aplica",
+        }
+
+        # --- 🟢 LÓGICA DE RESETEO (SOLUCIÓN AL ERROR) ---
+        # Esto se ejecuta AL PRINCIPIO de la recarga, antes de dibujar los widgets.
+        if ss.get("reset_solicitud_flag"):
+            for k in defaults:
+                if k != "sol_tipo": ss[k] = defaults[k]
+            del ss["reset_solicitud_flag"] # Apagamos la bandera
+            st.success("✅ Solicitud registrada y enviada correctamente."); st.balloons()
+        # ----------------------------------------------------
+
+        for k, v in defaults.items():
+            if k not in ss: ss[k] = v
+
+        # --- Callbacks para resetear dropdowns en cascada ---
+        def on_change_area():
+            ss.sol_perfil = "Selecciona..."
+            ss.sol_rol = "Selecciona..."
+            ss.sol_horario = "Selecciona..."
+            ss.sol_turno = ""
     
-    def on_change_perfil():
-        ss.sol_rol = "Selecciona..."
-        ss.sol_horario = "Selecciona..."
-        ss.sol_turno = ""
+        def on_change_perfil():
+            ss.sol_rol = "Selecciona..."
+            ss.sol_horario = "Selecciona..."
+            ss.sol_turno = ""
         
-    def on_change_horario():
-        ss.sol_turno = horarios_dict.get(ss.sol_horario, "") if ss.sol_horario != "Selecciona..." else ""
-
-    # -----------------------------------------------------------------
-    # --- PASO 1: SELECCIONAR TIPO ---
-    # -----------------------------------------------------------------
-    st.markdown("### 1) Tipo de Solicitud")
-    st.selectbox(
-        "Tipo de Solicitud en Zoho (*)",
-        ["Selecciona...", "Alta", "Modificación", "Baja"],
-        key="sol_tipo"
-    )
+        def on_change_horario():
+            ss.sol_turno = horarios_dict.get(ss.sol_horario, "") if ss.sol_horario != "Selecciona..." else ""
+
+        # -----------------------------------------------------------------
+        # --- PASO 1: SELECCIONAR TIPO ---
+        # -----------------------------------------------------------------
+        st.markdown("### 1) Tipo de Solicitud")
+        st.selectbox(
+            "Tipo de Solicitud en Zoho (*)",
+            ["Selecciona...", "Alta", "Modificación", "Baja"],
+            key="sol_tipo"
+        )
 
-    # -----------------------------------------------------------------
-    # --- FORMULARIO 1: BAJA ---
-    # -----------------------------------------------------------------
-    if ss.sol_tipo == "Baja":
-        st.markdown("### 2) Datos del Usuario a dar de baja")
-        with st.form("solicitud_form_baja", clear_on_submit=True):
-            nombre = st.text_input("Nombre Completo de Usuario (*)")
-            correo_user = st.text_input("Correo institucional del usuario (*)")
-            correo_solicitante = st.text_input("Correo de quien lo solicita (*)")
+        # -----------------------------------------------------------------
+        # --- FORMULARIO 1: BAJA ---
+        # -----------------------------------------------------------------
+        if ss.sol_tipo == "Baja":
+            st.markdown("### 2) Datos del Usuario a dar de baja")
+            with st.form("solicitud_form_baja", clear_on_submit=True):
+                nombre = st.text_input("Nombre Completo de Usuario (*)")
+                correo_user = st.text_input("Correo institucional del usuario (*)")
+                correo_solicitante = st.text_input("Correo de quien lo solicita (*)")
             
-            st.caption("(*) Campos obligatorios")
-            submitted_baja = st.form_submit_button("✔️ Enviar Baja", use_container_width=True)
-
-            if submitted_baja:
-                if not nombre or not correo_user or not correo_solicitante:
-                    st.warning("⚠️ Faltan campos obligatorios.")
-                else:
-                    try:
-                        fila_sol = [
-                            now_mx_str(), "Baja", nombre.strip(), correo_user.strip(), 
-                            "N/A", "N/A", "N/A", "", "", "", "", _email_norm(correo_solicitante),
-                            "Pendiente", "", "", str(uuid4()), "", ""
-                        ]
-                        header_s = sheet_solicitudes.row_values(1); fila_sol = fila_sol[:len(header_s)]
-                        with_backoff(sheet_solicitudes.append_row, fila_sol, value_input_option='USER_ENTERED')
+                st.caption("(*) Campos obligatorios")
+                submitted_baja = st.form_submit_button("✔️ Enviar Baja", use_container_width=True)
+
+                if submitted_baja:
+                    if not nombre or not correo_user or not correo_solicitante:
+                        st.warning("⚠️ Faltan campos obligatorios.")
+                    else:
+                        try:
+                            fila_sol = [
+                                now_mx_str(), "Baja", nombre.strip(), correo_user.strip(),
+                                "N/A", "N/A", "N/A", "", "", "", "", _email_norm(correo_solicitante),
+                                "Pendiente", "", "", str(uuid4()), "", ""
+                            ]
+                            header_s = get_headers("Sheet1"); fila_sol = fila_sol[:len(header_s)]
+                            append_row_coalesced(sheet_solicitudes, fila_sol, value_input_option='USER_ENTERED')
+                            clear_records_cache()   # invalidar caché
                         
-                        resumen_baja = f"Tipo: Baja<br>Nombre: {nombre}<br>Correo usuario: {correo_user}<br>Solicitante: {correo_solicitante}"
-                        enviar_correo(f"Solicitud CRM: Baja - {nombre}", resumen_baja, correo_solicitante)
+                            resumen_baja = [("Tipo", "Baja"), ("Nombre", nombre), ("Correo usuario", correo_user), ("Solicitante", correo_solicitante)]
+                            enviar_correo(f"Solicitud CRM: Baja - {nombre}", resumen_baja, correo_solicitante)
                         
-                        # Activamos la bandera y recargamos
-                        ss.reset_solicitud_flag = True
-                        st.rerun()
-
-                    except Exception as e: 
-                        st.error(f"❌ Error al registrar baja: {e}")
-        st.stop() 
-
-    # -----------------------------------------------------------------
-    # --- FORMULARIO 2: ALTA / MODIFICACIÓN ---
-    # -----------------------------------------------------------------
-    elif ss.sol_tipo in ["Alta", "Modificación"]:
+                            # Activamos la bandera y recargamos
+                            ss.reset_solicitud_flag = True
+                            st.rerun(scope="fragment")
+
+                        except Exception as e:
+                            st.error(f"❌ Error al registrar baja: {e}")
+            st.stop()
+
+        # -----------------------------------------------------------------
+        # --- FORMULARIO 2: ALTA / MODIFICACIÓN ---
+        # -----------------------------------------------------------------
+        elif ss.sol_tipo in ["Alta", "Modificación"]:
         
-        # --- CASCADA DE DROPDOWNS ---
-        st.markdown("### 2) Definición del Puesto (cascada)")
-        areas = ["Selecciona..."] + list(estructura_roles.keys())
-        area_idx = areas.index(ss.sol_area) if ss.sol_area in areas else 0
-        st.selectbox("Área (*)", areas, index=area_idx, key="sol_area", on_change=on_change_area)
+            # --- CASCADA DE DROPDOWNS ---
+            st.markdown("### 2) Definición del Puesto (cascada)")
+            area_idx = AREA_IDX.get(ss.sol_area, 0)
+            st.selectbox("Área (*)", AREAS, index=area_idx, key="sol_area", on_change=on_change_area)
         
-        perfiles_disp = ["Selecciona..."]
-        if ss.sol_area in estructura_roles:
-            perfiles_disp += list(estructura_roles[ss.sol_area].keys())
-        if ss.sol_perfil not in perfiles_disp: ss.sol_perfil = "Selecciona..."
-        perfil_idx = perfiles_disp.index(ss.sol_perfil)
-        st.selectbox("Perfil (*)", perfiles_disp, index=perfil_idx, key="sol_perfil", on_change=on_change_perfil)
+            perfiles_disp = PERFILES_BY_AREA.get(ss.sol_area, (_SEL,))
+            if ss.sol_perfil not in perfiles_disp: ss.sol_perfil = "Selecciona..."
+            perfil_idx = perfiles_disp.index(ss.sol_perfil)
+            st.selectbox("Perfil (*)", perfiles_disp, index=perfil_idx, key="sol_perfil", on_change=on_change_perfil)
         
-        roles_disp = ["Selecciona..."]
-        if ss.sol_area in estructura_roles and ss.sol_perfil in estructura_roles[ss.sol_area]:
-            roles_disp += estructura_roles[ss.sol_area][ss.sol_perfil]
-        if ss.sol_rol not in roles_disp: ss.sol_rol = "Selecciona..."
-        rol_idx = roles_disp.index(ss.sol_rol)
-        st.selectbox("Rol (*)", roles_disp, index=rol_idx, key="sol_rol")
-
-        requiere_horario = ss.sol_perfil in {"Agente de Call Center", "Ejecutivo AC"}
-        if requiere_horario:
-            st.markdown("### 3) Horario de trabajo (*)")
-            horarios_disp = ["Selecciona..."] + list(horarios_dict.keys())
-            st.selectbox("Horario", horarios_disp, key="sol_horario", on_change=on_change_horario)
-            st.text_input("Turno (Automático)", value=ss.sol_turno, disabled=True)
+            roles_disp = ROLES_BY_AP.get((ss.sol_area, ss.sol_perfil), (_SEL,))
+            if ss.sol_rol not in roles_disp: ss.sol_rol = "Selecciona..."
+            rol_idx = roles_disp.index(ss.sol_rol)
+            st.selectbox("Rol (*)", roles_disp, index=rol_idx, key="sol_rol")
+
+            requiere_horario = ss.sol_perfil in {"Agente de Call Center", "Ejecutivo AC"}
+            if requiere_horario:
+                st.markdown("### 3) Horario de trabajo (*)")
+                st.selectbox("Horario", HORARIOS, key="sol_horario", on_change=on_change_horario)
+                st.text_input("Turno (Automático)", value=ss.sol_turno, disabled=True)
         
-        # --- INICIO DEL FORMULARIO ---
-        with st.form("solicitud_form_alta_mod", clear_on_submit=True):
-            st.markdown("### 4) Datos del Usuario")
-            c1, c2 = st.columns(2)
-            with c1: nombre = st.text_input("Nombre Completo de Usuario (*)", key="sol_nombre_input_form")
-            with c2: correo = st.text_input("Correo institucional del usuario (*)", key="sol_correo_input_form")
-
-            show_numeros = ss.sol_rol in numeros_por_rol
-            if show_numeros:
-                st.markdown("### 5) Extensiones y Salida (*)")
-                nums_cfg = numeros_por_rol.get(ss.sol_rol, {})
-                lista_in_raw  = nums_cfg.get("Numero_IN", [])
-                lista_out_raw = nums_cfg.get("Numero_Saliente", [])
-
-                # Auto-selección si solo hay 1 número disponible
-                if len(lista_in_raw) == 1:
-                    num_in = lista_in_raw[0]
-                    st.info(f"📞 Número IN asignado automáticamente: **{num_in}**")
-                elif len(lista_in_raw) > 1:
-                    nums_in_list = ["Selecciona número IN (*)"] + lista_in_raw
-                    c3, _ = st.columns(2)
-                    with c3: num_in = st.selectbox("Número IN (*)", nums_in_list, key="sol_num_in_form")
-                else:
-                    num_in = "No aplica"
-
-                if len(lista_out_raw) == 1:
-                    num_out = lista_out_raw[0]
-                    st.info(f"📤 Número Saliente asignado automáticamente: **{num_out}**")
-                elif len(lista_out_raw) > 1:
-                    nums_out_list = ["Selecciona número Saliente (*)"] + lista_out_raw
-                    _, c4 = st.columns(2)
-                    with c4: num_out = st.selectbox("Número Saliente (*)", nums_out_list, key="sol_num_out_form")
+            # --- INICIO DEL FORMULARIO ---
+            with st.form("solicitud_form_alta_mod", clear_on_submit=True):
+                st.markdown("### 4) Datos del Usuario")
+                c1, c2 = st.columns(2)
+                with c1: nombre = st.text_input("Nombre Completo de Usuario (*)", key="sol_nombre_input_form")
+                with c2: correo = st.text_input("Correo institucional del usuario (*)", key="sol_correo_input_form")
+
+                show_numeros = ss.sol_rol in numeros_por_rol
+                if show_numeros:
+                    st.markdown("### 5) Extensiones y Salida (*)")
+                    nums_cfg = numeros_por_rol.get(ss.sol_rol, {})
+                    lista_in_raw  = nums_cfg.get("Numero_IN", [])
+                    lista_out_raw = nums_cfg.get("Numero_Saliente", [])
+
+                    # Auto-selección si solo hay 1 número disponible
+                    if len(lista_in_raw) == 1:
+                        num_in = lista_in_raw[0]
+                        st.info(f"📞 Número IN asignado automáticamente: **{num_in}**")
+                    elif len(lista_in_raw) > 1:
+                        nums_in_list = ["Selecciona número IN (*)"] + lista_in_raw
+                        c3, _ = st.columns(2)
+                        with c3: num_in = st.selectbox("Número IN (*)", nums_in_list, key="sol_num_in_form")
+                    else:
+                        num_in = "No aplica"
+
+                    if len(lista_out_raw) == 1:
+                        num_out = lista_out_raw[0]
+                        st.info(f"📤 Número Saliente asignado automáticamente: **{num_out}**")
+                    elif len(lista_out_raw) > 1:
+                        nums_out_list = ["Selecciona número Saliente (*)"] + lista_out_raw
+                        _, c4 = st.columns(2)
+                        with c4: num_out = st.selectbox("Número Saliente (*)", nums_out_list, key="sol_num_out_form")
+                    else:
+                        num_out = "No aplica"
                 else:
-                    num_out = "No aplica"
-            else:
-                num_in, num_out = "No aplica", "No aplica"
+                    num_in, num_out = "No aplica", "No aplica"
 
-            st.markdown("### 6) Horario Especial")
-            trabaja_sabado = st.checkbox("📅 ¿Trabajará en sábado?", key="sol_sabado_form")
+                st.markdown("### 6) Horario Especial")
+                trabaja_sabado = st.checkbox("📅 ¿Trabajará en sábado?", key="sol_sabado_form")
 
-            st.markdown("### 7) Quién Solicita")
-            correo_solicitante_form = st.text_input("Correo de quien lo solicita (*)", key="sol_correo_sol_input_form")
+                st.markdown("### 7) Quién Solicita")
+                correo_solicitante_form = st.text_input("Correo de quien lo solicita (*)", key="sol_correo_sol_input_form")
             
-            st.caption("(*) Campos obligatorios")
-            submitted_sol = st.form_submit_button("✔️ Enviar Solicitud", use_container_width=True)
+                st.caption("(*) Campos obligatorios")
+                submitted_sol = st.form_submit_button("✔️ Enviar Solicitud", use_container_width=True)
 
-            if submitted_sol:
-                tipo, area, perfil = ss.sol_tipo, ss.sol_area, ss.sol_perfil
-                rol, horario, turno = ss.sol_rol, ss.sol_horario, ss.sol_turno
+                if submitted_sol:
+                    tipo, area, perfil = ss.sol_tipo, ss.sol_area, ss.sol_perfil
+                    rol, horario, turno = ss.sol_rol, ss.sol_horario, ss.sol_turno
                 
-                if not nombre or not correo or not correo_solicitante_form:
-                    st.warning("⚠️ Faltan campos básicos."); st.stop()
-                if area == "Selecciona..." or perfil == "Selecciona..." or rol == "Selecciona...":
-                    st.warning("⚠️ Faltan campos de Área/Perfil/Rol."); st.stop()
-                if requiere_horario and horario == "Selecciona...":
-                    st.warning("⚠️ Selecciona un horario válido."); st.stop()
-                # Validar números obligatorios cuando hay más de una opción
-                if show_numeros:
-                    nums_cfg_check = numeros_por_rol.get(rol, {})
-                    if len(nums_cfg_check.get("Numero_IN", [])) > 1 and num_in.startswith("Selecciona"):
-                        st.warning("⚠️ Debes seleccionar un Número IN para este rol."); st.stop()
-                    if len(nums_cfg_check.get("Numero_Saliente", [])) > 1 and num_out.startswith("Selecciona"):
-                        st.warning("⚠️ Debes seleccionar un Número Saliente para este rol."); st.stop()
+                    if not nombre or not correo or not correo_solicitante_form:
+                        st.warning("⚠️ Faltan campos básicos."); st.stop()
+                    if area == "Selecciona..." or perfil == "Selecciona..." or rol == "Selecciona...":
+                        st.warning("⚠️ Faltan campos de Área/Perfil/Rol."); st.stop()
+                    if requiere_horario and horario == "Selecciona...":
+                        st.warning("⚠️ Selecciona un horario válido."); st.stop()
+                    # Validar números obligatorios cuando hay más de una opción
+                    if show_numeros:
+                        nums_cfg_check = numeros_por_rol.get(rol, {})
+                        if len(nums_cfg_check.get("Numero_IN", [])) > 1 and num_in.startswith("Selecciona"):
+                            st.warning("⚠️ Debes seleccionar un Número IN para este rol."); st.stop()
+                        if len(nums_cfg_check.get("Numero_Saliente", [])) > 1 and num_out.startswith("Selecciona"):
+                            st.warning("⚠️ Debes seleccionar un Número Saliente para este rol."); st.stop()
 
-                try:
-                    num_in_val  = "" if (not show_numeros or num_in == "No aplica") else str(num_in)
-                    num_out_val = "" if (not show_numeros or num_out == "No aplica") else str(num_out)
-                    horario_val = "" if (not requiere_horario or horario == "Selecciona...") else horario
-                    turno_val   = "" if (not requiere_horario) else turno
-                    check_sabado_val = "TRUE" if trabaja_sabado else "FALSE"  # columna S = CheckSS
-
-                    fila_sol = [
-                        now_mx_str(), tipo, nombre.strip(), correo.strip(),   # A B C D
-                        area, perfil, rol,                                      # E F G
-                        num_in_val, num_out_val, horario_val, turno_val,       # H I J K
-                        _email_norm(correo_solicitante_form), "Pendiente",     # L M
-                        "", "", str(uuid4()), "", "",                           # N O P Q R
-                        check_sabado_val                                        # S = CheckSS
-                    ]
-                    header_s = sheet_solicitudes.row_values(1); fila_sol = fila_sol[:len(header_s)]
-                    with_backoff(sheet_solicitudes.append_row, fila_sol, value_input_option='USER_ENTERED')
+                    try:
+                        num_in_val  = "" if (not show_numeros or num_in == "No aplica") else str(num_in)
+                        num_out_val = "" if (not show_numeros or num_out == "No aplica") else str(num_out)
+                        horario_val = "" if (not requiere_horario or horario == "Selecciona...") else horario
+                        turno_val   = "" if (not requiere_horario) else turno
+                        check_sabado_val = "TRUE" if trabaja_sabado else "FALSE"  # columna S = CheckSS
+
+                        fila_sol = [
+                            now_mx_str(), tipo, nombre.strip(), correo.strip(),   # A B C D
+                            area, perfil, rol,                                      # E F G
+                            num_in_val, num_out_val, horario_val, turno_val,       # H I J K
+                            _email_norm(correo_solicitante_form), "Pendiente",     # L M
+                            "", "", str(uuid4()), "", "",                           # N O P Q R
+                            check_sabado_val                                        # S = CheckSS
+                        ]
+                        header_s = get_headers("Sheet1"); fila_sol = fila_sol[:len(header_s)]
+                        append_row_coalesced(sheet_solicitudes, fila_sol, value_input_option='USER_ENTERED')
+                        clear_records_cache()   # invalidar caché
                     
-                    sabado_str  = "Sí" if trabaja_sabado else "No"
-                    in_str      = num_in_val  if num_in_val  else "No aplica"
-                    out_str     = num_out_val if num_out_val else "No aplica"
-                    resumen_email = (
-                        f"Tipo: {tipo}<br>"
-                        f"Nombre: {nombre}<br>"
-                        f"Correo usuario: {correo}<br>"
-                        f"Solicitante: {correo_solicitante_form}<br>"
-                        f"Área: {area}<br>"
-                        f"Perfil: {perfil}<br>"
-                        f"Rol: {rol}<br>"
-                        f"Número IN: {in_str}<br>"
-                        f"Número Saliente: {out_str}<br>"
-                        f"Trabaja sábado: {sabado_str}"
-                    )
-                    enviar_correo(f"Solicitud CRM: {tipo} - {nombre}", resumen_email, correo_solicitante_form)
+                        sabado_str  = "Sí" if trabaja_sabado else "No"
+                        in_str      = num_in_val  if num_in_val  else "No aplica"
+                        out_str     = num_out_val if num_out_val else "No aplica"
+                        resumen_email = [
+                            ("Tipo", tipo),
+                            ("Nombre", nombre),
+                            ("Correo usuario", correo),
+                            ("Solicitante", correo_solicitante_form),
+                            ("Área", area),
+                            ("Perfil", perfil),
+                            ("Rol", rol),
+                            ("Número IN", in_str),
+                            ("Número Saliente", out_str),
+                            ("Trabaja sábado", sabado_str),
+                        ]
+                        enviar_correo(f"Solicitud CRM: {tipo} - {nombre}", resumen_email, correo_solicitante_form)
                     
-                    # 🟢 AQUÍ ESTÁ EL CAMBIO CLAVE: Activamos bandera y recargamos
-                    ss.reset_solicitud_flag = True
-                    st.rerun()
+                        # 🟢 AQUÍ ESTÁ EL CAMBIO CLAVE: Activamos bandera y recargamos
+                        ss.reset_solicitud_flag = True
+                        st.rerun(scope="fragment")
                     
-                except Exception as e: 
-                    st.error(f"❌ Error al registrar solicitud: {e}")
+                    except Exception as e:
+                        st.error(f"❌ Error al registrar solicitud: {e}")
+
+    _solicitudes_section()
 
 # --- 3. INCIDENCIAS CRM (V3.2 + Correo Nuevo) ---
 elif seccion == "🛠️ Incidencias CRM":
@@ -610,8 +1080,7 @@ elif seccion == "🛠️ Incidencias CRM":
         descripcion = st.text_area("Descripción detallada (*)", height=150)
         file = st.file_uploader(
             "Adjuntar Imagen/Video (Evidencia)",
-            type=["jpg", "jpeg", "png", "gif", "bmp", "webp",
-                  "mp4", "mov", "avi", "wmv", "mkv", "webm", "ogg"],
+            type=UPLOAD_TYPES,
         )
         
         confirmacion = st.checkbox(check_texto)
@@ -626,23 +1095,37 @@ elif seccion == "🛠️ Incidencias CRM":
             st.error("🛑 **Link Inválido:** Debe ser un enlace de Zoho CRM.")
         else:
             tiene_archivo = file is not None
-            with st.spinner("🤖 Validando ticket..."):
-                desc_completa = f"{descripcion}. [Usuario confirmó: {confirmacion}]"
-                es_valido, motivo = validar_incidencia_con_ia(asunto, desc_completa, cat, link, tiene_archivo)
-            
-            if not es_valido:
-                st.error("✋ Solicitud rechazada por el sistema")
-                st.info(f"💡 **Motivo:** {motivo}")
+            valid_f, msg = validate_upload_limits(file)
+            if not valid_f:
+                st.error(msg)
             else:
-                valid_f, msg = validate_upload_limits(file)
-                if not valid_f: st.error(msg)
+                desc_completa = f"{descripcion}. [Usuario confirmó: {confirmacion}]"
+                # Las reglas locales van primero: un rechazo obvio no paga la subida
+                es_valido, motivo = _rule_check(cat, asunto, desc_completa, link, tiene_archivo)
+                url = ""
+                if es_valido:
+                    # La subida a GCS y la consulta a OpenAI son independientes:
+                    # corren en paralelo y la espera total es la más lenta de las dos.
+                    with st.spinner("🤖 Validando ticket y subiendo evidencia..." if file else "🤖 Validando ticket..."):
+                        fut_up = submit_with_ctx(subir_evidencia, file) if file else None
+                        es_valido, motivo = validar_incidencia_con_ia(asunto, desc_completa, cat, link, tiene_archivo)
+                        url, err_up = fut_up.result() if fut_up else ("", None)
+                        url = url or ""
+                    # Los avisos de la subida se pintan aquí, en el hilo del script
+                    if err_up:
+                        st.error(err_up)
+                    elif fut_up and es_valido:
+                        st.toast("☁️ Archivo subido (Link válido por 7 días).", icon="☁️")
+
+                if not es_valido:
+                    st.error("✋ Solicitud rechazada por el sistema")
+                    st.info(f"💡 **Motivo:** {motivo}")
                 else:
-                    url = ""
-                    if file: url = upload_to_gcs(file, f"{uuid4()}_{file.name}", file.type) or ""
                     row = [now_mx_str(), _email_norm(mail), asunto, cat, descripcion, link, "Pendiente", "", "", "", "", str(uuid4()), url]
-                    with_backoff(sheet_incidencias.append_row, row)
+                    append_row_coalesced(sheet_incidencias, row)
+                    clear_records_cache()   # invalidar caché
                     enviar_correo(f"Incidencia Recibida: {asunto}", descripcion, mail)
-                    st.success("✅ Incidencia registrada."); st.balloons(); time.sleep(2); st.rerun()
+                    st.toast("✅ Incidencia registrada."); st.rerun()
 
 # ===================== SECCIÓN FUSIONADA: ACCESOS Y BUZÓN =====================
 elif seccion == "🔑 Accesos y Buzón":
@@ -696,14 +1179,14 @@ elif seccion == "🔑 Accesos y Buzón":
                         now_mx_str(), _email_norm(correo_solicitante), tipo_solicitud,
                         asunto_acc, justificacion, "", "Pendiente", "", "", id_unico, ""
                     ]
-                    with_backoff(sheet_quejas.append_row, row_unificado)
+                    append_row_coalesced(sheet_quejas, row_unificado)
+                    clear_records_cache()   # invalidar caché
                     msg_exito = "✅ Solicitud enviada."
                     if "Queja" in tipo_solicitud: msg_exito = "✅ Reporte recibido."
                     elif "Sugerencia" in tipo_solicitud: msg_exito = "✅ Sugerencia recibida."
-                    st.success(msg_exito)
-                    resumen = f"Tipo: {tipo_solicitud}<br>Asunto: {asunto_acc}<br>Detalle: {justificacion}"
+                    resumen = [("Tipo", tipo_solicitud), ("Asunto", asunto_acc), ("Detalle", justificacion)]
                     enviar_correo(f"CRM Solicitud: {tipo_solicitud}", resumen, correo_solicitante)
-                    st.balloons(); time.sleep(2); st.rerun()
+                    st.toast(msg_exito); st.rerun()
                 except Exception as e:
                     st.error(f"❌ Error al guardar: {e}")
 
@@ -755,16 +1238,17 @@ elif seccion == "🔑 Accesos y Buzón":
                         id_nr,                              # 10. ID
                         ""                                  # 11. Respuesta Admin
                     ]
-                    with_backoff(sheet_quejas.append_row, row_nuevo_rol)
+                    append_row_coalesced(sheet_quejas, row_nuevo_rol)
+                    clear_records_cache()   # invalidar caché
 
-                    resumen_nr = (
-                        f"Área: {nr_area}<br>Perfil: {nr_perfil}<br>Rol: {nr_rol}<br>"
-                        f"Usuario destino: {nr_correo_usr}<br>Justificación: {nr_justificacion}"
-                    )
+                    resumen_nr = [
+                        ("Área", nr_area), ("Perfil", nr_perfil), ("Rol", nr_rol),
+                        ("Usuario destino", nr_correo_usr), ("Justificación", nr_justificacion),
+                    ]
                     enviar_correo(f"Solicitud Nuevo Rol: {nr_rol} ({nr_area})", resumen_nr, nr_correo)
 
-                    st.success("✅ Solicitud de nuevo rol enviada. El equipo la revisará y te notificará.")
-                    st.balloons(); time.sleep(2); st.rerun()
+                    st.toast("✅ Solicitud de nuevo rol enviada. El equipo la revisará y te notificará.")
+                    st.rerun()
                 except Exception as e:
                     st.error(f"❌ Error al guardar: {e}")
 
@@ -774,17 +1258,14 @@ elif seccion == "🔑 Accesos y Buzón":
 elif seccion == "🔐 Zona Admin":
     st.markdown("## 🔐 Zona Administrativa")
 
-    # Correos de Jefes para Copia (CC)
-    lista_supervisores = list(st.secrets["admin"]["emails"])
-
-    ADMIN_PASS = st.secrets.get("admin", {}).get("password", "")
-    if not ADMIN_PASS:
+    if not _ADMIN_PASS:
         st.error("⚠️ Admin no configurado: falta admin.password en secrets.")
         st.stop()
 
     pwd = st.text_input("Contraseña Admin", type="password")
 
-    if pwd == ADMIN_PASS or st.session_state.get("is_admin", False):
+    # compare_digest: la comparación tarda lo mismo sin importar cuántos caracteres coinciden
+    if st.session_state.get("is_admin", False) or (pwd and hmac.compare_digest(pwd.encode(), _ADMIN_PASS.encode())):
         st.session_state.is_admin = True
 
         col_refresh, col_calif = st.columns(2)
@@ -792,13 +1273,11 @@ elif seccion == "🔐 Zona Admin":
             st.cache_resource.clear()
             st.cache_data.clear()
             st.toast("♻️ Conexión reiniciada...")
-            time.sleep(1)
             st.rerun()
         if col_calif.button("⭐ Auto-calificar vencidos (3 días)"):
             with st.spinner("Revisando registros sin calificación..."):
                 auto_calificar_vencidos()
-            st.success("✅ Revisión completada. Registros sin calificar después de 3 días → 👍")
-            time.sleep(1)
+            st.toast("✅ Revisión completada. Registros sin calificar después de 3 días → 👍")
             st.rerun()
         st.divider()
 
@@ -806,243 +1285,12 @@ elif seccion == "🔐 Zona Admin":
 
         # ================= TAB 1: SOLICITUDES (CORREGIDO IDS y EMAILS) =================
         with tab1:
-            st.subheader("Gestión de Solicitudes")
-            with st.spinner("Cargando..."):
-                dfs = get_records_simple(sheet_solicitudes, "Sheet1")
-
-            if dfs.empty:
-                st.warning("⚠️ No hay datos o conexión lenta.")
-            else:
-                st.dataframe(dfs, use_container_width=True)
-                
-                # Buscamos la columna IDS (Clave única)
-                col_id_name = "IDS" if "IDS" in dfs.columns else "ID"
-                
-                if col_id_name in dfs.columns:
-                    ids = dfs[dfs[col_id_name] != ""][col_id_name].unique().tolist()
-                    if ids:
-                        st.divider()
-                        # Selector en la ÚLTIMA solicitud
-                        idx_def = len(ids)-1 if len(ids) > 0 else 0
-                        sel_id = st.selectbox("ID Solicitud", ids, index=idx_def)
-                        
-                        row_s = dfs[dfs[col_id_name] == sel_id].iloc[0]
-                        
-                        st.info(f"**{row_s.get('TipoS')}** - {row_s.get('NombreS')} ({row_s.get('CorreoS')})")
-                        st.caption(f"Solicitado por: {row_s.get('SolicitanteS')}")
-                        
-                        c_st, _ = st.columns(2)
-                        st_act = row_s.get("EstadoS", "Pendiente")
-                        opts = ["Pendiente", "En proceso", "Atendido"]
-                        idx_st = opts.index(st_act) if st_act in opts else 0
-                        
-                        nuevo_estado = c_st.selectbox("Estado", opts, index=idx_st, key="st_sol_main")
-                        
-                        # Guardamos en CredencialesZohoS
-                        val_resp = row_s.get("CredencialesZohoS", "")
-                        mensaje_respuesta = st.text_area("Resolución / Credenciales", value=val_resp, key="resp_sol_main")
-                        
-                        c1, c2 = st.columns(2)
-                        if c1.button("💾 Actualizar Solicitud"):
-                            cell = with_backoff(sheet_solicitudes.find, sel_id)
-                            if cell:
-                                header = sheet_solicitudes.row_values(1)
-                                try:
-                                    # Buscamos índices dinámicamente
-                                    col_st = header.index("EstadoS") + 1
-                                    col_cred = header.index("CredencialesZohoS") + 1
-                                    
-                                    sheet_solicitudes.update_cell(cell.row, col_st, nuevo_estado)
-                                    sheet_solicitudes.update_cell(cell.row, col_cred, mensaje_respuesta)
-                                    
-                                    # Correo al SolicitanteS
-                                    correo_sol = row_s.get("SolicitanteS")
-                                    if SEND_EMAILS and nuevo_estado == "Atendido" and mensaje_respuesta and correo_sol:
-                                        try:
-                                            yag = yagmail.SMTP(user=st.secrets["email"]["user"], password=st.secrets["email"]["password"])
-                                            headers = {"From": f"Equipo CRM <{st.secrets['email']['user']}>"}
-                                            html = f"""
-                                            <div style="font-family: Arial;">
-                                                <h3 style="color: green;">¡Solicitud Atendida!</h3>
-                                                <p>Tu solicitud <strong>{row_s.get('TipoS')}</strong> para <strong>{row_s.get('NombreS')}</strong> ha sido completada.</p>
-                                                <pre style="background:#f4f4f4;padding:10px;">{mensaje_respuesta}</pre>
-                                                <hr style="border:1px solid #eee;">
-                                                <p style="font-size:13px;color:#555;">
-                                                    ⭐ <strong>¿Cómo calificarías la atención recibida?</strong><br>
-                                                    Responde este correo con 👍 si quedaste satisfecho/a, o con 👎 si no fue lo que esperabas.<br>
-                                                    <em>Si no recibes respuesta en 3 días, se registrará automáticamente como 👍 (Buena).</em>
-                                                </p>
-                                                <p>Saludos,<br>CRM UAG</p>
-                                            </div>
-                                            """
-                                            yag.send(to=correo_sol, cc=lista_supervisores, subject=f"✅ Finalizado: {row_s.get('TipoS')}", contents=[html], headers=headers)
-                                            st.toast("📧 Enviado.")
-                                        except Exception as e: st.error(f"Error correo: {e}")
-                                    
-                                    st.success("✅ Actualizado"); time.sleep(1); st.rerun()
-                                except Exception as e: st.error(f"Error columnas Excel: {e}")
-
-                        if c2.button("🗑️ Eliminar Solicitud"):
-                            cell = with_backoff(sheet_solicitudes.find, sel_id)
-                            if cell:
-                                with_backoff(sheet_solicitudes.delete_rows, cell.row)
-                                st.warning("Eliminado"); time.sleep(1); st.rerun()
+            render_solicitudes_tab()
 
         # ================= TAB 2: INCIDENCIAS (CON BOTÓN IA) =================
         with tab2:
-            st.subheader("Gestión de Incidencias")
-            with st.spinner("Cargando..."):
-                dfi = get_records_simple(sheet_incidencias, "Incidencias")
+            render_incidencias_tab()
 
-            if dfi.empty:
-                st.warning("⚠️ No hay datos.")
-            else:
-                st.dataframe(dfi, use_container_width=True)
-                if "IDI" in dfi.columns:
-                    ids_i = dfi[dfi["IDI"] != ""]["IDI"].unique().tolist()
-                    if ids_i:
-                        st.divider()
-                        idx_def_i = len(ids_i)-1 if len(ids_i) > 0 else 0
-                        sel_idi = st.selectbox("ID Incidencia", ids_i, index=idx_def_i, key="sel_inc")
-                        row_i = dfi[dfi["IDI"] == sel_idi].iloc[0]
-                        
-                        st.info(f"**{row_i.get('Asunto')}** | {row_i.get('CorreoI')}")
-                        
-                        # --- BOTÓN DE IA (RAG) ---
-                        if st.button("✨ Sugerir Respuesta (IA)"):
-                            # Nota: Asegúrate de tener la función 'generar_respuesta_ia' definida o importada
-                            # Si no la tienes en este archivo, comenta estas líneas para evitar error.
-                            try:
-                                with st.spinner("Leyendo manual y casos previos..."):
-                                    st.session_state.rag = generar_respuesta_ia(row_i.get("Asunto"), row_i.get("DescripcionI"), dfi)
-                            except NameError:
-                                st.warning("La función de IA RAG no está definida en este contexto.")
-
-                        c_st_i, _ = st.columns(2)
-                        st_act_i = row_i.get("EstadoI", "Pendiente")
-                        opts_i = ["Pendiente", "En proceso", "Atendido"]
-                        idx_i = opts_i.index(st_act_i) if st_act_i in opts_i else 0
-                        
-                        nuevo_estado_i = c_st_i.selectbox("Estado", opts_i, index=idx_i, key="st_inc_main")
-                        
-                        val_rag = st.session_state.get("rag", row_i.get("RespuestadeSolicitudI",""))
-                        respuesta = st.text_area("Respuesta Técnica", value=val_rag, key="resp_inc_main")
-                        
-                        c1, c2 = st.columns(2)
-                        if c1.button("💾 Responder Incidencia"):
-                            cell = with_backoff(sheet_incidencias.find, sel_idi)
-                            if cell:
-                                header = sheet_incidencias.row_values(1)
-                                col_st = header.index("EstadoI") + 1
-                                col_resp = header.index("RespuestadeSolicitudI") + 1
-                                sheet_incidencias.update_cell(cell.row, col_st, nuevo_estado_i)
-                                sheet_incidencias.update_cell(cell.row, col_resp, respuesta)
-                                
-                                correo_usu = row_i.get("CorreoI")
-                                if SEND_EMAILS and nuevo_estado_i == "Atendido" and respuesta and correo_usu:
-                                    try:
-                                        yag = yagmail.SMTP(user=st.secrets["email"]["user"], password=st.secrets["email"]["password"])
-                                        headers = {"From": f"Equipo CRM <{st.secrets['email']['user']}>"}
-                                        html = f"""
-                                        <div style="font-family: Arial;">
-                                            <h3 style="color: green;">✅ Incidencia Resuelta</h3>
-                                            <p>Asunto: <strong>{row_i.get('Asunto')}</strong></p>
-                                            <p style="background:#e8f4fd;padding:10px;">{respuesta}</p>
-                                            <hr style="border:1px solid #eee;">
-                                            <p style="font-size:13px;color:#555;">
-                                                ⭐ <strong>¿Cómo calificarías la atención recibida?</strong><br>
-                                                Responde este correo con 👍 si quedaste satisfecho/a, o con 👎 si no fue lo que esperabas.<br>
-                                                <em>Si no recibes respuesta en 3 días, se registrará automáticamente como 👍 (Buena).</em>
-                                            </p>
-                                            <p>Saludos,<br>CRM UAG</p>
-                                        </div>
-                                        """
-                                        lista_supervisores = list(st.secrets["admin"]["emails"])
-                                        yag.send(to=correo_usu, cc=lista_supervisores, subject=f"✅ Resuelto: {row_i.get('Asunto')}", contents=[html], headers=headers)
-                                        st.toast("📧 Notificado.")
-                                    except Exception as e:
-                                        log.error(f"tab2_responder_incidencia: error enviando correo a {correo_usu}: {e}")
-                                st.success("✅ Actualizado"); time.sleep(1); st.rerun()
-
-                        if c2.button("🗑️ Eliminar Incidencia"):
-                            cell = with_backoff(sheet_incidencias.find, sel_idi)
-                            if cell:
-                                with_backoff(sheet_incidencias.delete_rows, cell.row)
-                                st.warning("Eliminado"); time.sleep(1); st.rerun()
-
-  # ================= TAB 3: GESTIÓN UNIFICADA (En hoja Quejas) =================
+        # ================= TAB 3: GESTIÓN UNIFICADA (En hoja Quejas) =================
         with tab3:
-            st.subheader("Gestión de Accesos, Quejas y Sugerencias")
-        
-            # Leemos de QUEJAS
-            dfq = get_records_simple(sheet_quejas, "Quejas")
-        
-            if dfq.empty:
-                st.info("No hay registros pendientes.")
-            else:
-                st.dataframe(dfq, use_container_width=True)
-            
-                # Buscamos la columna ID (En tu hoja Quejas suele ser IDQ o ID)
-                # Ajusta "IDQ" si así se llama en tu Excel, o "ID" si es genérico.
-                col_id_target = "IDQ" if "IDQ" in dfq.columns else "ID"
-            
-                if col_id_target in dfq.columns:
-                    ids_q = dfq[dfq[col_id_target] != ""][col_id_target].unique().tolist()
-                
-                    if ids_q:
-                        st.divider()
-                        # Selector inteligente
-                        sel_id_q = st.selectbox("Seleccionar Registro", ids_q, format_func=lambda x: f"{x} - {dfq[dfq[col_id_target]==x].iloc[0].get('TipoQ', 'Registro')}")
-                    
-                        row_q = dfq[dfq[col_id_target] == sel_id_q].iloc[0]
-                    
-                        # Nombres de columnas basados en tu hoja Quejas (ajusta si difieren)
-                        tipo_val = row_q.get('TipoQ') or row_q.get('Tipo')
-                        correo_val = row_q.get('CorreoQ') or row_q.get('Correo')
-                        desc_val = row_q.get('DescripciónQ') or row_q.get('Justificacion') or row_q.get('Detalle')
-                        estado_val = row_q.get('EstadoQ') or row_q.get('Estado') or "Pendiente"
-                        resp_val = row_q.get('RespuestaQ') or row_q.get('RespuestaAdmin') or ""
-                    
-                        st.markdown(f"**Tipo:** {tipo_val} | **Solicitante:** {correo_val}")
-                        st.warning(f"**Detalle:** {desc_val}")
-                    
-                        c_st_q, _ = st.columns(2)
-                        opts_q = ["Pendiente", "Aprobado", "Rechazado", "En Revisión", "Atendido"]
-                        idx_q = opts_q.index(estado_val) if estado_val in opts_q else 0
-                    
-                        nuevo_estado = c_st_q.selectbox("Estado", opts_q, index=idx_q, key="st_fusion_q")
-                        nueva_resp = st.text_area("Respuesta Admin", value=resp_val, key="rsp_fusion_q")
-                    
-                        if st.button("💾 Guardar Cambios"):
-                            cell = with_backoff(sheet_quejas.find, sel_id_q)
-                            if cell:
-                                header_q = with_backoff(sheet_quejas.row_values, 1)
-                                _estado_col = next((c for c in ["EstadoQ", "Estado"] if c in header_q), None)
-                                _resp_col   = next((c for c in ["RespuestaQ", "RespuestaAdmin"] if c in header_q), None)
-                                _updated = False
-                                if _estado_col:
-                                    sheet_quejas.update_cell(cell.row, header_q.index(_estado_col) + 1, nuevo_estado)
-                                    _updated = True
-                                else:
-                                    log.error("tab3: columna Estado no encontrada en sheet_quejas")
-                                if _resp_col:
-                                    sheet_quejas.update_cell(cell.row, header_q.index(_resp_col) + 1, nueva_resp)
-                                    _updated = True
-                                else:
-                                    log.error("tab3: columna Respuesta no encontrada en sheet_quejas")
-
-                                if _updated:
-                                    # Notificar
-                                    if SEND_EMAILS and nuevo_estado in ["Aprobado", "Rechazado", "Atendido"]:
-                                        asunto_mail = f"Actualización: {tipo_val}"
-                                        body_mail = f"<p>Estado actualizado a: <strong>{nuevo_estado}</strong>.</p><p>Respuesta: {nueva_resp}</p>"
-                                        try:
-                                            yag = yagmail.SMTP(user=st.secrets["email"]["user"], password=st.secrets["email"]["password"])
-                                            yag.send(to=correo_val, subject=asunto_mail, contents=[body_mail])
-                                            st.toast("📧 Notificación enviada.")
-                                        except Exception as e:
-                                            log.error(f"tab3_guardar_cambios: error enviando correo a {correo_val}: {e}")
-
-                                    st.success("Registro actualizado.")
-                                    time.sleep(1)
-                                    st.rerun()
+            render_quejas_tab()
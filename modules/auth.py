@@ -1,22 +1,35 @@
 import re
+import hashlib
 import logging
 from uuid import uuid4
 
 import streamlit as st
 import pandas as pd
 
-from modules.sheets import get_records_simple, sheet_usuarios
+from modules.sheets import with_backoff, _values_to_df, sheet_usuarios
 
 log = logging.getLogger("auth")
 
-EMAIL_RE = re.compile(r'([A-Z0-9._%+-]+@[A-Z0-9.-]+\.[A-Z]{2,})', re.I)
+# Sin re.I: la entrada se pasa a minúsculas antes de buscar, así el motor
+# no hace case-folding carácter por carácter.
+EMAIL_RE = re.compile(r'([a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,})')
 
 
 def _email_norm(s: str) -> str:
+    """Extrae y normaliza un correo suelto (campos de formulario, login).
+    Para columnas completas usar email_norm_series.
+    """
     if s is None:
         return ""
-    m = EMAIL_RE.search(str(s))
-    return m.group(1).strip().lower() if m else str(s).strip().lower()
+    t = str(s).strip().lower()
+    m = EMAIL_RE.search(t)
+    return m.group(1) if m else t
+
+
+def email_norm_series(col: pd.Series) -> pd.Series:
+    """_email_norm vectorizada sobre una columna completa."""
+    t = col.fillna("").astype(str).str.strip().str.lower()
+    return t.str.extract(EMAIL_RE.pattern, expand=False).fillna(t)
 
 
 def _norm(x):
@@ -27,9 +40,10 @@ def _is_unrated(val: str) -> bool:
     return _norm(val) in ("", "pendiente", "na", "n/a", "sin calificacion", "-")
 
 
-def do_login(m):
+def do_login(m, rerun: bool = True):
     st.session_state.update({"usuario_logueado": _email_norm(m), "session_id": str(uuid4())})
-    st.rerun()
+    if rerun:
+        st.rerun()
 
 
 def do_logout():
@@ -37,14 +51,31 @@ def do_logout():
     st.rerun()
 
 
+def _pw_key(p: str) -> bytes:
+    """Llave del dict de usuarios: digest BLAKE2 de la contraseña, no el texto plano."""
+    return hashlib.blake2b(p.encode(), digest_size=16).digest()
+
+
 @st.cache_data(ttl=300, show_spinner=False)
 def get_usuarios_dict() -> dict:
-    """Carga el dict contraseña→email desde la hoja Usuarios.
+    """Carga el dict hash(contraseña)→email desde la hoja Usuarios.
     TTL de 5 min para que los usuarios nuevos sean visibles sin reiniciar.
     """
-    udf = get_records_simple(sheet_usuarios, "Usuarios")
-    return {
-        str(p).strip(): _email_norm(c)
-        for p, c in zip(udf.get("Contraseña", []), udf.get("Correo", []))
-        if str(p).strip()
-    }
+    # Lectura directa, sin get_records_simple: la hoja en claro no se cachea
+    udf = _values_to_df(with_backoff(sheet_usuarios.get_all_values))
+    if "Contraseña" not in udf.columns or "Correo" not in udf.columns:
+        return {}
+    pw = udf["Contraseña"].astype(str).str.strip()
+    em = email_norm_series(udf["Correo"])
+    mask = pw.ne("")
+    return {_pw_key(p): c for p, c in zip(pw[mask], em[mask])}
+
+
+def buscar_usuario(pw: str):
+    """Correo del usuario con esa contraseña, o None."""
+    try:
+        usuarios = get_usuarios_dict()
+    except Exception as e:   # no se cachea: el siguiente intento vuelve a leer
+        log.error(f"buscar_usuario: error leyendo hoja Usuarios: {e}")
+        return None
+    return usuarios.get(_pw_key(pw.strip()))
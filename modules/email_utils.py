@@ -1,4 +1,10 @@
+import html
 import logging
+import smtplib
+import threading
+import time
+from string import Template
+from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
 import yagmail
@@ -7,51 +13,157 @@ log = logging.getLogger("email_utils")
 
 SEND_EMAILS = bool(st.secrets.get("email", {}).get("send_enabled", False))
 
+# Los envíos salen del hilo del script: la UI no espera el handshake SMTP.
+# Un solo worker basta: la conexión SMTP compartida envía de uno en uno.
+_MAIL_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mail")
+# smtplib no es thread-safe: protege la conexión también ante envíos directos.
+_SMTP_LOCK = threading.Lock()
 
-def enviar_correo(asunto, cuerpo_detalle, para):
-    if not SEND_EMAILS:
-        return
+
+# --- Plantillas HTML (se compilan una vez; en cada envío solo se sustituyen los campos) ---
+_PIE_CALIFICACION = """
+    <hr style="border:1px solid #eee;">
+    <p style="font-size:13px;color:#555;">
+        ⭐ <strong>¿Cómo calificarías la atención recibida?</strong><br>
+        Responde este correo con 👍 si quedaste satisfecho/a, o con 👎 si no fue lo que esperabas.<br>
+        <em>Si no recibes respuesta en 3 días, se registrará automáticamente como 👍 (Buena).</em>
+    </p>
+    <p>Saludos,<br>CRM UAG</p>
+"""
+
+TPL_ACUSE = Template("""
+<div style="font-family: Arial, sans-serif; color: #333;">
+    <h2 style="color: #004B93;">Confirmación de Recepción</h2>
+    <p>Hola,</p>
+    <p>Hemos recibido tu solicitud con el asunto: <strong>$asunto</strong>.</p>
+    <p>Se ha notificado al equipo de CRM y tu caso ha entrado en la cola de gestión.
+    Será atendido en su momento conforme a la carga de trabajo.</p>
+    <p><strong>No es necesario que respondas a este correo.</strong>
+    Te notificaremos nuevamente por este medio en cuanto haya una actualización o resolución.</p>
+    <hr>
+    <p style="font-size: 12px; color: #666;">Detalle recibido:<br>$detalle</p>
+    <br>
+    <p>Atentamente,<br><strong>Equipo de Gestión CRM</strong></p>
+</div>
+""")
+
+TPL_SOLICITUD_ATENDIDA = Template("""
+<div style="font-family: Arial;">
+    <h3 style="color: green;">¡Solicitud Atendida!</h3>
+    <p>Tu solicitud <strong>$tipo</strong> para <strong>$nombre</strong> ha sido completada.</p>
+    <pre style="background:#f4f4f4;padding:10px;">$respuesta</pre>
+""" + _PIE_CALIFICACION + """</div>
+""")
+
+TPL_INCIDENCIA_RESUELTA = Template("""
+<div style="font-family: Arial;">
+    <h3 style="color: green;">✅ Incidencia Resuelta</h3>
+    <p>Asunto: <strong>$asunto</strong></p>
+    <p style="background:#e8f4fd;padding:10px;">$respuesta</p>
+""" + _PIE_CALIFICACION + """</div>
+""")
+
+TPL_ACTUALIZACION = Template("<p>Estado actualizado a: <strong>$estado</strong>.</p><p>Respuesta: $respuesta</p>")
+
+
+def render(tpl: Template, **campos) -> str:
+    """Sustituye los campos escapando HTML: son textos capturados por usuarios/admins."""
+    return tpl.substitute({k: html.escape("" if v is None else str(v)) for k, v in campos.items()})
+
+
+def remitente() -> dict:
+    """Encabezado From común a todos los correos del equipo."""
+    return {"From": f"Equipo CRM <{st.secrets['email']['user']}>"}
+
+
+# Conexión SMTP compartida entre envíos y sesiones. Vive en el módulo (no en
+# st.cache_resource: se usa desde el worker de correo, que no tiene contexto
+# de Streamlit) y solo se toca con _SMTP_LOCK tomado. Se renueva cada
+# SMTP_TTL segundos: los servidores cortan las sesiones largas.
+SMTP_TTL = 1800
+_yag = None
+_yag_desde = 0.0
+
+
+def _cerrar_yag():
+    global _yag
+    if _yag is not None:
+        try:
+            _yag.close()
+        except Exception as e:
+            log.warning(f"_cerrar_yag: error cerrando conexión SMTP: {e}")
+        _yag = None
+
+
+def _get_yag():
+    """Conexión SMTP autenticada; abre una nueva si no hay o si ya expiró."""
+    global _yag, _yag_desde
+    if _yag is None or time.monotonic() - _yag_desde > SMTP_TTL:
+        _cerrar_yag()
+        _yag = yagmail.SMTP(user=st.secrets["email"]["user"], password=st.secrets["email"]["password"])
+        _yag_desde = time.monotonic()
+    return _yag
+
+
+def send_mail(**kwargs):
+    """yag.send con la conexión compartida; si el servidor la cerró, reconecta una vez.
+
+    Ante cualquier otro fallo descarta la conexión para que el siguiente
+    envío abra una nueva en vez de reutilizar una que quedó a medias.
+    """
+    with _SMTP_LOCK:
+        try:
+            _get_yag().send(**kwargs)
+        except smtplib.SMTPServerDisconnected:
+            _cerrar_yag()
+            _get_yag().send(**kwargs)
+        except Exception:
+            _cerrar_yag()
+            raise
+
+
+def _send_logged(**kwargs):
     try:
-        # Obtenemos el usuario y password de los secrets
-        user_email = st.secrets["email"]["user"]
-        password = st.secrets["email"]["password"]
+        send_mail(**kwargs)
+        log.info(f"Correo enviado a {kwargs.get('to')} con copia a {kwargs.get('cc')}")
+    except Exception as e:
+        log.error(f"enviar_correo: error enviando a {kwargs.get('to')}: {e}")
+
 
-        yag = yagmail.SMTP(user=user_email, password=password)
+def send_mail_async(**kwargs):
+    """Encola el envío en el worker de correo; los errores quedan en el log."""
+    return _MAIL_POOL.submit(_send_logged, **kwargs)
 
+
+def _detalle_html(detalle) -> str:
+    """Texto libre o pares (etiqueta, valor) → HTML; los valores van escapados
+    (los captura el usuario) y los pares se separan con <br>."""
+    if isinstance(detalle, str):
+        return html.escape(detalle)
+    return "<br>".join(f"{etiqueta}: {html.escape('' if v is None else str(v))}" for etiqueta, v in detalle)
+
+
+def enviar_correo(asunto, detalle, para):
+    """Acuse de recibo al solicitante. `detalle`: texto libre o lista de pares (etiqueta, valor)."""
+    if not SEND_EMAILS:
+        return
+    try:
         # --- LISTA DE COPIAS (CC) ---
         # Aquí pones los correos de los jefes/supervisores.
         # Al ponerlos aquí, se aplicará para TODOS los envíos del sistema.
         cc_list = list(st.secrets["admin"]["emails"])
 
         to = [para]
-        headers = {"From": f"Equipo CRM <{user_email}>"}
-
-        # --- TU DISEÑO HTML (INTACTO) ---
-        mensaje_html = f"""
-        <div style="font-family: Arial, sans-serif; color: #333;">
-            <h2 style="color: #004B93;">Confirmación de Recepción</h2>
-            <p>Hola,</p>
-            <p>Hemos recibido tu solicitud con el asunto: <strong>{asunto}</strong>.</p>
-            <p>Se ha notificado al equipo de CRM y tu caso ha entrado en la cola de gestión.
-            Será atendido en su momento conforme a la carga de trabajo.</p>
-            <p><strong>No es necesario que respondas a este correo.</strong>
-            Te notificaremos nuevamente por este medio en cuanto haya una actualización o resolución.</p>
-            <hr>
-            <p style="font-size: 12px; color: #666;">Detalle recibido:<br>{cuerpo_detalle}</p>
-            <br>
-            <p>Atentamente,<br><strong>Equipo de Gestión CRM</strong></p>
-        </div>
-        """
-
-        # --- EL ENVÍO CON CC ---
-        yag.send(
+        mensaje_html = TPL_ACUSE.substitute(asunto=html.escape(asunto), detalle=_detalle_html(detalle))
+
+        # --- EL ENVÍO CON CC (en segundo plano) ---
+        send_mail_async(
             to=to,
             cc=cc_list,  # <--- AQUÍ SE AGREGAN LAS COPIAS
             subject=f"Recibido: {asunto}",
             contents=[mensaje_html],
-            headers=headers,
+            headers=remitente(),
         )
-        log.info(f"Correo enviado a {to} con copia a {cc_list}")
 
     except Exception as e:
         log.error(f"enviar_correo: error enviando a {para}: {e}")
@@ -1,10 +1,16 @@
 import time
 import random
 import logging
+import threading
+from concurrent.futures import Future
+from itertools import zip_longest
 
 import streamlit as st
 import pandas as pd
 import gspread
+from gspread.utils import rowcol_to_a1
+import requests
+from requests.adapters import HTTPAdapter
 from google.oauth2.service_account import Credentials
 
 log = logging.getLogger("sheets")
@@ -17,59 +23,354 @@ SHEET_ID = (
 )
 
 
+# Códigos HTTP que vale la pena reintentar (cuota / fallas temporales del servidor)
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+def _is_transient(e: Exception) -> bool:
+    """True si el error es temporal: cortes de red o un HTTP reintentable.
+
+    Cubre gspread.APIError / errores de google-resumable-media (`.response`)
+    y google.api_core (`.code`). Auth, 400, 404, errores de programación, etc.
+    no se reintentan: fallan de inmediato en vez de dormir ~30 s.
+    """
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is None:
+        status = getattr(e, "code", None)
+    return status in RETRYABLE_STATUS
+
+
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 16.0
+# Tope para un Retry-After del servidor: más que esto deja la UI colgada
+RETRY_AFTER_CAP = 30.0
+
+
+def _retry_after(e: Exception):
+    """Segundos indicados por el servidor en Retry-After (429/503), si los mandó."""
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        return min(float(headers.get("Retry-After")), RETRY_AFTER_CAP)
+    except (TypeError, ValueError):
+        return None
+
+
 def with_backoff(fn, *args, **kwargs):
+    # Jitter "decorrelacionado": cada espera es aleatoria entre la base y 3× la anterior,
+    # así varias sesiones que chocaron con la cuota no reintentan todas al mismo tiempo.
+    sleep = BACKOFF_BASE
     for i in range(5):
         try:
             return fn(*args, **kwargs)
         except Exception as e:
+            if not _is_transient(e):
+                log.error(f"with_backoff: error no reintentable en '{getattr(fn, '__name__', fn)}': {e}")
+                raise
             log.warning(f"with_backoff: intento {i + 1}/5 fallido en '{getattr(fn, '__name__', fn)}': {e}")
-            time.sleep(min(1 * (2 ** i) + random.random(), 16))
+            sleep = min(BACKOFF_CAP, random.uniform(BACKOFF_BASE, sleep * 3))
+            time.sleep(_retry_after(e) or sleep)
     log.error(f"with_backoff: todos los intentos fallaron para '{getattr(fn, '__name__', fn)}'")
     raise Exception("API Failed")
 
 
-@st.cache_resource(ttl=3600)
-def get_gspread_client():
-    creds = Credentials.from_service_account_info(
+def append_rows_safe(ws, rows, value_input_option: str = "RAW"):
+    """Agrega varias filas en una sola llamada (values.append) con reintentos.
+
+    Usar siempre en lugar de `append_row` en bucle: cada llamada cuenta
+    contra la cuota de escritura de Sheets sin importar cuántas filas lleve.
+    INSERT_ROWS inserta filas nuevas en vez de sobrescribir las vacías que
+    haya debajo de la tabla.
+    """
+    if not rows:
+        return None
+    return with_backoff(ws.append_rows, rows, value_input_option=value_input_option,
+                        insert_data_option="INSERT_ROWS")
+
+
+def delete_rows_batch(ws, filas):
+    """Borra varias filas (números 1-based) en un solo spreadsheets.batchUpdate.
+
+    Las peticiones van de abajo hacia arriba para que cada borrado no
+    desplace los índices de los que faltan.
+    """
+    filas = sorted(set(filas), reverse=True)
+    if not filas:
+        return None
+    reqs = [{"deleteDimension": {"range": {
+        "sheetId": ws.id, "dimension": "ROWS", "startIndex": r - 1, "endIndex": r,
+    }}} for r in filas]
+    return with_backoff(ws.spreadsheet.batch_update, {"requests": reqs})
+
+
+def ids_en_filas(ws, sheet_name: str, col_id: str, filas) -> list:
+    """Valor actual de la columna `col_id` en cada fila, leído en fresco.
+
+    Una sola llamada (values.batchGet de las celdas sueltas): sirve para
+    confirmar que un número de fila sacado del caché sigue apuntando al
+    mismo registro antes de escribir o borrar. La fila de encabezados viaja
+    en la misma llamada: si ya no coincide con el caché de 10 min (columnas
+    insertadas o movidas), se invalida y las celdas se releen en la columna
+    correcta.
+    """
+    col = get_col_idx(sheet_name)[col_id]
+    resp = with_backoff(ws.batch_get, ["1:1"] + [rowcol_to_a1(n, col) for n in filas])
+    header = resp[0][0] if resp[0] else []
+    if header != get_headers(sheet_name):
+        log.warning(f"ids_en_filas: los encabezados de '{sheet_name}' cambiaron, se invalida su caché")
+        clear_headers_cache()
+        col = get_col_idx(sheet_name)[col_id]
+        resp = [None] + with_backoff(ws.batch_get, [rowcol_to_a1(n, col) for n in filas])
+    return [vr[0][0] if vr and vr[0] else "" for vr in resp[1:]]
+
+
+# Filas en cola por (hoja, value_input_option) y claves con una escritura en curso
+_pending_appends: dict = {}
+_flushing: set = set()
+_append_lock = threading.Lock()
+# Espera máxima de una fila encolada a que termine la escritura en vuelo
+# (con todos los reintentos de with_backoff) y le toque su turno.
+APPEND_TIMEOUT = 180
+
+
+class AppendIncierto(Exception):
+    """La escritura de la fila se interrumpió o tardó demasiado: puede haber
+    quedado en la hoja o no. No reenviar sin revisar primero."""
+
+
+class _FilaPendiente:
+    __slots__ = ("row", "fut", "turno", "lote")
+
+    def __init__(self, row):
+        self.row = row
+        self.fut = Future()
+        self.turno = threading.Event()   # se activa al resolverse o al recibir el relevo
+        self.lote = None                 # filas a escribir si esta sesión toma el relevo
+
+
+def _escribir_lote(ws, key, lote, value_input_option):
+    """Escribe un lote y pasa el relevo a la primera fila que se encoló mientras tanto."""
+    try:
+        append_rows_safe(ws, [f.row for f in lote], value_input_option=value_input_option)
+        for f in lote:
+            f.fut.set_result(True)
+    except Exception as e:
+        for f in lote:
+            f.fut.set_exception(e)
+    finally:
+        for f in lote:
+            if not f.fut.done():   # BaseException a media escritura: resultado desconocido
+                f.fut.set_exception(AppendIncierto("escritura interrumpida; revisa la hoja antes de reenviar"))
+        with _append_lock:
+            siguiente = _pending_appends.pop(key, [])
+            if siguiente:
+                siguiente[0].lote = siguiente
+            else:
+                _flushing.discard(key)
+        for f in lote:
+            f.turno.set()
+        if siguiente:
+            siguiente[0].turno.set()
+
+
+def append_row_coalesced(ws, row, value_input_option: str = "RAW"):
+    """Agrega una fila agrupándola con las de otras sesiones concurrentes.
+
+    Si no hay escritura en curso, la fila se escribe de inmediato. Si la hay,
+    se encola; al terminar, quien escribía pasa el relevo a la primera de la
+    cola, que escribe todas las encoladas en un solo `append_rows`. Cada
+    sesión escribe a lo más un lote. Cada llamada regresa (o lanza la
+    excepción) hasta que su fila quedó escrita: no se confirma al usuario
+    nada que no esté en la hoja.
+    """
+    key = (ws.id, value_input_option)
+    fila = _FilaPendiente(row)
+    with _append_lock:
+        if key in _flushing:
+            _pending_appends.setdefault(key, []).append(fila)
+        else:
+            _flushing.add(key)
+            fila.lote = [fila]
+    if fila.lote is None and not fila.turno.wait(APPEND_TIMEOUT):
+        with _append_lock:
+            cola = _pending_appends.get(key, [])
+            if fila in cola:
+                # Sigue en cola: nadie la ha enviado, se puede retirar sin duda
+                cola.remove(fila)
+                raise TimeoutError("append_row_coalesced: la hoja no respondió a tiempo; la fila no se escribió")
+        if fila.lote is None and not fila.fut.done():
+            # Ya va dentro de la escritura de otra sesión: el resultado se desconoce
+            raise AppendIncierto("la escritura sigue en curso; revisa la hoja antes de reenviar")
+    if fila.lote is not None and not fila.fut.done():
+        _escribir_lote(ws, key, fila.lote, value_input_option)
+    return fila.fut.result()
+
+
+HTTP_POOL_SIZE = 32
+
+
+def mount_http_pool(session: requests.Session) -> requests.Session:
+    """Monta un pool keep-alive amplio en la sesión HTTP para no reabrir TLS
+    en cada llamada cuando varias sesiones de Streamlit usan el mismo cliente.
+    Sin max_retries: los reintentos ya los hace with_backoff.
+    """
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_resource
+def get_sa_credentials():
+    """Credenciales de la cuenta de servicio compartidas por Sheets y GCS:
+    un solo token OAuth (con todos los scopes) que se refresca al expirar.
+    """
+    return Credentials.from_service_account_info(
         st.secrets["google_service_account"],
         scopes=[
             "https://www.googleapis.com/auth/spreadsheets",
             "https://www.googleapis.com/auth/drive",
+            "https://www.googleapis.com/auth/cloud-platform",
         ],
     )
-    return gspread.authorize(creds)
 
 
-@st.cache_resource(ttl=3600)
+@st.cache_resource
+def get_gspread_client():
+    client = gspread.authorize(get_sa_credentials())
+    # gspread >= 6 guarda la sesión en client.http_client; versiones previas en client.session
+    session = getattr(getattr(client, "http_client", client), "session", None)
+    if session is not None:
+        mount_http_pool(session)
+    return client
+
+
+@st.cache_resource
 def get_spreadsheet():
     return with_backoff(get_gspread_client().open_by_key, SHEET_ID)
 
 
-@st.cache_resource(ttl=3600)
+@st.cache_resource
 def get_sheets():
-    b = get_spreadsheet()
-    return {k: b.worksheet(k) for k in ["Sheet1", "Incidencias", "Quejas", "Accesos", "Usuarios"]}
+    # Un solo fetch de metadatos para todas las pestañas (b.worksheet(k) hace uno por pestaña)
+    todas = {ws.title: ws for ws in with_backoff(get_spreadsheet().worksheets)}
+    requeridas = ["Sheet1", "Incidencias", "Quejas", "Accesos", "Usuarios"]
+    faltantes = [k for k in requeridas if k not in todas]
+    if faltantes:
+        raise gspread.WorksheetNotFound(f"Hojas faltantes en el spreadsheet: {faltantes}")
+    return {k: todas[k] for k in requeridas}
+
+
+# Hojas de datos que se leen juntas en un solo values.batchGet.
+# Usuarios no va: trae las contraseñas en claro y no debe quedar en los cachés
+# compartidos (auth.get_usuarios_dict la lee aparte y solo guarda digests).
+# Accesos no se lee en ningún lado, así que no se pide.
+DATA_TABS = ("Sheet1", "Incidencias", "Quejas")
+
+
+def _values_to_df(v: list) -> pd.DataFrame:
+    """Convierte la matriz de valores de Sheets (1a fila = encabezados) en DataFrame."""
+    if not v:
+        return pd.DataFrame()
+    h, d = v[0], v[1:]
+    # Transponer en una pasada (zip_longest rellena filas cortas con "")
+    # en vez de concatenar una lista nueva por cada fila.
+    cols = list(zip_longest(*d, fillvalue=""))[:len(h)]
+    cols += [("",) * len(d)] * (len(h) - len(cols))
+    df = pd.DataFrame(dict(enumerate(cols)))
+    df.columns = h   # asignación posicional: conserva encabezados repetidos
+    return df
+
+
+@st.cache_data(ttl=60, max_entries=4, show_spinner=False)
+def load_all_tabs() -> dict:
+    """Lee todas las DATA_TABS con una sola llamada HTTP (values.batchGet).
+
+    Si falla, la excepción no se cachea y get_records_simple cae a la
+    lectura individual de la hoja.
+    """
+    resp = with_backoff(get_spreadsheet().values_batch_get, list(DATA_TABS))
+    # La API devuelve los rangos en el mismo orden en que se pidieron
+    return {
+        name: _values_to_df(vr.get("values", []))
+        for name, vr in zip(DATA_TABS, resp.get("valueRanges", []))
+    }
 
 
-@st.cache_data(ttl=60, show_spinner=False)
+@st.cache_data(ttl=60, max_entries=16, show_spinner=False)
 def get_records_simple(_ws, sheet_name: str = "") -> pd.DataFrame:
     """Lee una hoja de cálculo y la devuelve como DataFrame.
 
     `sheet_name` se incluye en el cache key para que cada hoja tenga
     su propia entrada — sin él, @st.cache_data ignora _ws (guión bajo)
     y todas las hojas compartirían el mismo resultado cacheado.
+    Las DATA_TABS salen del batch de load_all_tabs.
     """
+    if sheet_name in DATA_TABS:
+        try:
+            tabs = load_all_tabs()
+            if sheet_name in tabs:
+                return tabs[sheet_name]
+        except Exception as e:
+            log.warning(f"get_records_simple: batchGet falló, leyendo '{sheet_name}' sola: {e}")
     try:
-        v = with_backoff(_ws.get_all_values)
-        if not v:
-            return pd.DataFrame()
-        h, d = v[0], v[1:]
-        return pd.DataFrame([r + [""] * (len(h) - len(r)) for r in d], columns=h)
+        return _values_to_df(with_backoff(_ws.get_all_values))
     except Exception as e:
         log.error(f"get_records_simple: error leyendo hoja '{sheet_name or getattr(_ws, 'title', _ws)}': {e}")
         return pd.DataFrame()
 
 
+@st.cache_data(ttl="10m", max_entries=2, show_spinner=False)
+def _load_all_headers() -> dict:
+    """Fila 1 de todas las DATA_TABS en un solo values.batchGet."""
+    rangos = [f"'{t}'!1:1" for t in DATA_TABS]
+    resp = with_backoff(get_spreadsheet().values_batch_get, rangos)
+    return {
+        name: (vr.get("values") or [[]])[0]
+        for name, vr in zip(DATA_TABS, resp.get("valueRanges", []))
+    }
+
+
+@st.cache_data(ttl="10m", max_entries=8, show_spinner=False)
+def get_headers(sheet_name: str) -> list:
+    """Fila de encabezados de una hoja. Cambia casi nunca: se cachea 10 min
+    para que los submits y botones de Admin no gasten una lectura en ella.
+    Las DATA_TABS se piden juntas: el primer submit o botón trae todas.
+    """
+    if sheet_name in DATA_TABS:
+        try:
+            headers = _load_all_headers()
+            if sheet_name in headers:
+                return headers[sheet_name]
+        except Exception as e:
+            log.warning(f"get_headers: batchGet falló, leyendo encabezados de '{sheet_name}' sola: {e}")
+    return with_backoff(get_sheets()[sheet_name].row_values, 1)
+
+
+@st.cache_data(ttl="10m", max_entries=8, show_spinner=False)
+def get_col_idx(sheet_name: str) -> dict:
+    """Encabezado → número de columna (1-based). Con nombres repetidos gana
+    el primero, igual que header.index().
+    """
+    idx = {}
+    for i, h in enumerate(get_headers(sheet_name)):
+        idx.setdefault(h, i + 1)
+    return idx
+
+
+def clear_records_cache():
+    """Invalida las lecturas cacheadas; llamar después de cualquier escritura."""
+    get_records_simple.clear()
+    load_all_tabs.clear()
+
+
+def clear_headers_cache():
+    """Invalida los encabezados cacheados (y sus índices de columna)."""
+    _load_all_headers.clear()
+    get_headers.clear()
+    get_col_idx.clear()
+
+
 _sheets = get_sheets()
 sheet_solicitudes = _sheets["Sheet1"]
 sheet_incidencias = _sheets["Incidencias"]